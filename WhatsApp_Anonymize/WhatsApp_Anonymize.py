@@ -9,20 +9,37 @@ Parse and anonymize Whatsapp messages
 """
 
 # Import libraries
+import argparse
+import collections
+import contextlib
+import csv
+import glob
+import gzip
+import hashlib
+import hmac
+import http.server
+import itertools
+import json
+import math
+import mmap
 import pickle
-import pandas as pd
+import queue
+import random
 import re
 import os
+import sqlite3
 import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from array import array
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
-from datetime import datetime
-import spacy
-import names
-from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives.asymmetric import rsa
-from cryptography.hazmat.primitives import serialization
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.asymmetric import padding
+from datetime import datetime, timedelta
+# spacy, names, numpy and cryptography are imported where they are first
+# needed, so that --help and other light uses don't pay for loading them.
 
 # FILE PARAMETERS # # # # # #
 #
@@ -37,27 +54,202 @@ KEY_DIR = Path(Path.home() /
                'Dropbox/CoViD_ED_TF/Public_Key/')
 DATA_DIR = Path(Path.home() /
                 'Dropbox/CoViD_ED_TF/')
+NAMES_PATH = Path('/Users/RobertTeresi/Dropbox/CoViD_ED_TF/listofnames.csv')
+
+# Pipeline components Entity_Recognizer never reads from. Only the
+# entities and token offsets are used, so these are not loaded.
+UNUSED_PIPES = ['tagger', 'parser', 'attribute_ruler', 'lemmatizer',
+                'senter']
+
+# Time stamp in a message header in any of the date formats phones use,
+# e.g. "6/9/20, 3:08 PM", "09/06/2020, 15:08" or "09.06.20, 15:08". AM/PM
+# can also be written "pm", "p.m." or "p. m.", and newer exports put a
+# (narrow) no-break space before it. Those are written as characters, not
+# regex escapes, so the pattern also works as UTF-8 bytes. See TimeFormat.
+TIME_STAMP = (r'\d{1,2}[/.-]\d{1,2}[/.-]\d{2}(?:\d{2})?, '
+              r'\d{1,2}:\d{2}(?::\d{2})?'
+              r'(?:(?: |' '\u202f|\u00a0' r')?[AaPp]\.? ?[Mm]\.?)?')
+
+# Start of every message in an export, e.g. "6/9/20, 3:08 PM - ". Files
+# saved by Windows editors start with a byte order mark, which is skipped
+# so the first message isn't lost.
+HEADER_START = '(?:\ufeff)?'
+MESSAGE_HEADER = re.compile(HEADER_START + '(' + TIME_STAMP + ') - ')
+
+# PII that PIIScrubber replaces: kind -> (pattern, replacement, trigger).
+# A text can only match a kind if it contains its trigger. Earlier kinds
+# win where two could match, so emails go before mentions.
+PII_PATTERNS = {
+    'url': (r'(?:https?://|www\.)[^\s<>"]*[^\s<>".,;:!?)\]\'"]',
+            'URL', r'https?://|www\.'),
+    'email': (r'[\w.+\-]+@[\w\-]+(?:\.[\w\-]+)+', 'EMAIL', '@'),
+    # WhatsApp wraps names in mentions in \u2068 and \u2069. Mentions
+    # replaced by the first pass are left alone by the second.
+    'mention': (r'(?<!\w)@(?!PERSON\b)(?:\u2068[^\u2069\n]*\u2069|\w+)',
+                '@PERSON', '@'),
+    # International (E.164 with optional separators), then US and
+    # trunk-prefix national formats
+    'phone': (r'(?<![\w+])(?:\+(?:\d[ .()\-]{0,2}){6,14}\d'
+              r'|\(?\d{3}\)?[ .\-]?\d{3}[ .\-]\d{4}'
+              r'|0\d{2,4}[ .\-]?\d{3,4}[ .\-]?\d{3,4})(?!\w)',
+              'NUMBER', r'\d'),
+}
+
+# Used by Entity_Recognizer.needs_model to pass over texts without names
+PLACEHOLDERS = frozenset(['<Media omitted>', 'This message was deleted',
+                          'You deleted this message'])
+URL = re.compile(r'(?:https?://|www\.)\S+')
+WORD = re.compile(r'[^\W\d_]+')
+
+# Print every message as it is processed (--verbose)
+VERBOSE = False
 
 
 # Class definitions
+class RunStats(object):
+    """Collect timings, counters and peak memory for a run.
+
+    Use stage() around each step and count() for events. report() gives
+    everything as a dict and save() writes it as JSON. If profile_dir is
+    given, or the WHATSAPP_ANONYMIZE_PROFILE environment variable names a
+    directory, every stage is also profiled with cProfile and saved there
+    as <stage>.prof.
+
+    cProfile only sees the thread it is enabled on, so stage() profiles
+    the thread that enters it. Work on threads of its own, like Pipeline
+    stages, is profiled separately with profile().
+    """
+
+    def __init__(self, profile_dir=None):
+        """Initialize empty stats."""
+        self.started = datetime.now()
+        self.stages = dict()
+        self.counters = collections.Counter()
+        self.profile_dir = (profile_dir or
+                            os.environ.get('WHATSAPP_ANONYMIZE_PROFILE'))
+        self.profiles = dict()
+        self.profiling = False
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Time the body of a with block as stage name."""
+        profiler = None
+        if self.profile_dir and not self.profiling:
+            profiler = self.start_profiler(name)
+            self.profiling = profiler is not None
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield(None)
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                self.profiling = False
+            stage = self.stages.setdefault(name, {'wall_s': 0.0,
+                                                  'cpu_s': 0.0,
+                                                  'calls': 0})
+            stage['wall_s'] += time.perf_counter() - wall
+            stage['cpu_s'] += time.process_time() - cpu
+            stage['calls'] += 1
+            stage['peak_rss_mb'] = self.peak_rss_mb()
+
+    @contextlib.contextmanager
+    def profile(self, name):
+        """Profile the body of a with block on this thread as name."""
+        if not self.profile_dir or name is None:
+            yield(None)
+            return(None)
+        profiler = self.start_profiler(name)
+        try:
+            yield(None)
+        finally:
+            if profiler is not None:
+                profiler.disable()
+
+    def start_profiler(self, name):
+        """Enable the profiler for name and return it, or None.
+
+        From Python 3.12 on only one profiler can be on at a time, and it
+        sees every thread. If one is already on, for a stage or a Pipeline
+        thread, this work shows up in its profile instead.
+        """
+        import cProfile
+        profiler = self.profiles.get(name)
+        if profiler is None:
+            profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            return(None)
+        self.profiles[name] = profiler
+        return(profiler)
+
+    def count(self, name, n=1):
+        """Add n to counter name."""
+        self.counters[name] += n
+
+    @staticmethod
+    def peak_rss_mb():
+        """Return the peak resident memory of this process in MB."""
+        try:
+            import resource
+        except ImportError:
+            return(None)
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux reports kilobytes, macOS bytes
+        return(peak / (2 ** 20 if sys.platform == 'darwin' else 2 ** 10))
+
+    def report(self):
+        """Return the stats as a dict."""
+        report = {'started': self.started.isoformat(),
+                  'wall_s': (datetime.now() - self.started).total_seconds(),
+                  'peak_rss_mb': self.peak_rss_mb(),
+                  'stages': self.stages,
+                  'counters': dict(self.counters)}
+        if self.counters['prefilter_checked']:
+            report['prefilter_skip_rate'] = (
+                self.counters['prefilter_skipped'] /
+                self.counters['prefilter_checked'])
+        return(report)
+
+    def save(self, path):
+        """Write the report, and any profiles, to disk."""
+        with open(path, 'w') as file:
+            json.dump(self.report(), file, indent=2)
+        if self.profiles:
+            os.makedirs(self.profile_dir, exist_ok=True)
+        for name, profiler in self.profiles.items():
+            profiler.dump_stats(os.path.join(self.profile_dir,
+                                             name + '.prof'))
+
+
+STATS = RunStats()
+
+
 class Encryptor(object):
     """
     Generate public key and encrypt identifiers.
 
     key_dir is where the key will be stored. It should be a PosixPath
         (made using Path from pathlib).
+    deterministic makes encrypt_ids return a keyed hash of each identifier
+        instead of an RSA ciphertext, see pseudonymize.
+    threads is how many RSA operations encrypt_many and decrypt_many run
+        at once, one per core by default.
     """
 
-    def __init__(self, key_dir):
-        try:
-            self.load_public_key(key_dir)
-        except Exception:
-            try:
-                os.mkdir(key_dir)
-            except FileExistsError:
-                pass
-            self.generate_public_key(key_dir)
-            self.load_public_key(key_dir)
+    def __init__(self, key_dir, deterministic=False, threads=None):
+        self.key_dir = key_dir
+        self.deterministic = deterministic
+        self.threads = threads or os.cpu_count() or 1
+        self.hmac_key = None
+        self.padding = None
+        # Only make keys for a new key_dir. If either key is there, a
+        # problem loading them is an error, never a reason to replace them.
+        if not (os.path.exists(Path(key_dir / 'public_key.pem')) or
+                os.path.exists(Path(key_dir / 'private_key.pem'))):
+            os.makedirs(key_dir, exist_ok=True)
+            self.generate_keys(key_dir)
+        self.load_public_key(key_dir)
 
     def generate_keys(self, key_dir):
         """
@@ -65,9 +257,13 @@ class Encryptor(object):
 
         Only run this if there is no existing key.
         """
+        from cryptography.hazmat.backends import default_backend
+        from cryptography.hazmat.primitives import serialization
+        from cryptography.hazmat.primitives.asymmetric import rsa
+
         print("Generating key")
         private_key = rsa.generate_private_key(
-            public_exponent=849745,
+            public_exponent=65537,
             key_size=4096,
             backend=default_backend()
         )
@@ -92,6 +288,9 @@ class Encryptor(object):
 
     def load_public_key(self, key_dir):
         """Attach public key to class from file."""
+        from cryptography.hazmat.backends import default_backend
+        from cryptography.hazmat.primitives import serialization
+
         with open(Path(key_dir / 'public_key.pem'), 'rb') as file:
             self.public_key = serialization.load_pem_public_key(
                     file.read(),
@@ -104,75 +303,498 @@ class Encryptor(object):
                     backend=default_backend()
                     )
 
+    def load_hmac_key(self, key_dir):
+        """Attach the pseudonymization key to class, creating it if needed.
+
+        The key is random and stored on disk encrypted with the public key,
+        so only holders of the private key can use it.
+        """
+        path = Path(key_dir / 'hmac_key.bin')
+        if os.path.exists(path):
+            with open(path, 'rb') as file:
+                self.hmac_key = self.decrypt(file.read())
+        else:
+            self.hmac_key = os.urandom(32)
+            with open(path, 'wb') as file:
+                file.write(self.encrypt(self.hmac_key))
+
+    def pseudonymize(self, identifier):
+        """Return a short token that is always the same for an identifier.
+
+        The token is the first 128 bits of an HMAC-SHA256 of the identifier
+        in hex. Unlike encrypt it cannot be decrypted, but the same sender
+        gets the same token in every run and every file.
+        """
+        return(self.digest(identifier)[:32])
+
+    def digest(self, identifier):
+        """Return the HMAC-SHA256 of an identifier in hex."""
+        if self.hmac_key is None:
+            self.load_hmac_key(self.key_dir)
+        STATS.count('hmac_operations')
+        return(hmac.new(self.hmac_key, identifier.encode('utf-8'),
+                        hashlib.sha256).hexdigest())
+
+    def encrypt_ids(self, identifiers):
+        """Encrypt or pseudonymize identifiers depending on the mode.
+
+        RSA encryption goes through encrypt_many.
+        """
+        if self.deterministic:
+            return([self.pseudonymize(identifier)
+                    for identifier in identifiers])
+        return(self.encrypt_many(identifiers))
+
+    def oaep(self):
+        """Return the OAEP padding used for every RSA operation."""
+        if self.padding is None:
+            from cryptography.hazmat.primitives import hashes
+            from cryptography.hazmat.primitives.asymmetric import padding
+
+            self.padding = padding.OAEP(
+                mgf=padding.MGF1(algorithm=hashes.SHA256()),
+                algorithm=hashes.SHA256(),
+                label=None
+                )
+        return(self.padding)
+
     def encrypt(self, identifier):
         """Encrypt identifier and return encrypted bytearray."""
-        identifier = identifier.encode('utf-8')
-        return(self.public_key.encrypt(
-                    identifier,
-                    padding.OAEP(
-                        mgf=padding.MGF1(algorithm=hashes.SHA256()),
-                        algorithm=hashes.SHA256(),
-                        label=None
-                        )
-                    )
-               )
+        STATS.count('rsa_operations')
+        if isinstance(identifier, str):
+            identifier = identifier.encode('utf-8')
+        return(self.public_key.encrypt(identifier, self.oaep()))
+
+    def encrypt_many(self, identifiers):
+        """Encrypt a list of identifiers, see map_unique."""
+        return(self.map_unique(self.public_key.encrypt, [
+            identifier.encode('utf-8') if isinstance(identifier, str)
+            else identifier for identifier in identifiers]))
+
+    def decrypt_many(self, encrypted_messages):
+        """Decrypt a list of encrypted messages, see map_unique."""
+        return(self.map_unique(self.private_key.decrypt,
+                               list(encrypted_messages)))
+
+    def map_unique(self, operation, values):
+        """Return operation(value, padding) for each value, in order.
+
+        Each distinct value is only done once, so repeated identifiers get
+        the same ciphertext. The RSA operations are spread over a pool of
+        threads, OpenSSL releases the GIL while it works.
+        """
+        unique = list(dict.fromkeys(values))
+        STATS.count('rsa_operations', len(unique))
+        padding = self.oaep()
+        if self.threads > 1 and len(unique) > 1:
+            with ThreadPoolExecutor(min(self.threads, len(unique))) as pool:
+                results = list(pool.map(lambda value: operation(value,
+                                                                padding),
+                                        unique))
+        else:
+            results = [operation(value, padding) for value in unique]
+        results = dict(zip(unique, results))
+        return([results[value] for value in values])
+
+    def encrypt_blob(self, data):
+        """Encrypt bytes of any size with one RSA operation.
+
+        data is encrypted with a fresh Fernet key and only that key is
+        encrypted with the public key. Returns a dict holding both.
+        """
+        from cryptography.fernet import Fernet
+
+        data_key = Fernet.generate_key()
+        return({'key': self.encrypt(data_key),
+                'blob': Fernet(data_key).encrypt(data)})
+
+    def decrypt_blob(self, envelope):
+        """Decrypt a dict made by encrypt_blob."""
+        from cryptography.fernet import Fernet
+
+        return(Fernet(self.decrypt(envelope['key'])).decrypt(envelope['blob']))
 
     def decrypt(self, encrypted_message):
         """Decrypt encrypted message."""
-        return(self.private_key.decrypt(
-                            encrypted_message,
-                            padding.OAEP(
-                                mgf=padding.MGF1(algorithm=hashes.SHA256()),
-                                algorithm=hashes.SHA256(),
-                                label=None
-                                )
-                            )
-               )
+        STATS.count('rsa_operations')
+        return(self.private_key.decrypt(encrypted_message, self.oaep()))
 
 
 class TextParser(object):
     """Class that opens and parses files, then turns them into Texts."""
 
-    def __init__(self, path, print_contents=False):
-        """Read in data from file."""
-        with open(path) as file:
+    def __init__(self, path, print_contents=False, stream=False,
+                 encoding='utf-8', single_pass=False, mapped=False):
+        """Read in data from file.
+
+        If stream is True the file is not read here. Use iter_texts to read
+        it one message at a time instead. If single_pass is True,
+        parse_into_texts builds a MessageTable in one scan instead of using
+        the regex scans. If mapped is True as well, the file is not read
+        here either. parse_into_texts memory maps it and the table decodes
+        each message only when it is read.
+
+        The date format of the headers is detected once per file, see
+        time_format.
+        """
+        self.path = path
+        self.stream = stream
+        self.encoding = encoding
+        self.single_pass = single_pass or mapped
+        self.mapped = mapped
+        self.last = None  # (start, stamp, text) of last message read
+        self.format = None
+        if stream or mapped:
+            return(None)
+
+        with open(path, encoding=encoding) as file:
             self.file_contents = file.read()
 
             if print_contents:
                 print('Printing file contents...')
                 print(self.file_contents)
 
+    def time_format(self):
+        """Return the TimeFormat of the file, detecting it on first use."""
+        if self.format is None:
+            self.format = TimeFormat.detect(
+                self.map_file() if self.stream or self.mapped
+                else self.file_contents)
+        return(self.format)
+
     def parse_times(self, file):
         """Take in file and return Datetimes of each Whatsapp message."""
-        times = re.findall(r'\d{1,2}/\d{1,2}/\d{2}, \d{1,2}:\d{2} [AP]M - ',
-                           file)
-        times = [re.search(r'\d{1,2}/\d{1,2}/\d{2}, \d{1,2}:\d{2} [AP]M',
-                           time).group(0) for time in times]
-        return([datetime.strptime(time,
-                                  '%m/%d/%y, %I:%M %p') for time in times])
+        time_format = self.time_format()
+        return([time_format.parse(time)
+                for time in MESSAGE_HEADER.findall(file)])
 
     def parse_into_texts(self):
         """Take larger file and parse it into discrete messages."""
+        if self.single_pass:
+            tokenizer = MessageTokenizer(self.time_format())
+            if self.mapped:
+                self.WhatsAppTexts = MessageTable.from_contents(
+                    self.map_file(), tokenizer, encoding=self.encoding)
+            else:
+                self.WhatsAppTexts = MessageTable.from_contents(
+                    self.file_contents, tokenizer)
+            self.last = self.WhatsAppTexts.last
+            STATS.count('messages_parsed', len(self.WhatsAppTexts))
+            return(None)
+
+        self.last = self.find_last(self.file_contents)
+
         times = self.parse_times(self.file_contents)
 
-        texts = re.split(r'\n\n\d{1,2}/\d{1,2}/\d{2}, \d{1,2}:\d{2} [AP]M - ',
-                         self.file_contents)
-        texts = [re.sub(r'\d{1,2}/\d{1,2}/\d{2}, \d{1,2}:\d{2} [AP]M - ',
-                        '', text) for text in texts]
+        texts = re.split('\n\n' + TIME_STAMP + ' - ', self.file_contents)
+        texts = [MESSAGE_HEADER.sub('', text) for text in texts]
 
         self.WhatsAppTexts = [WhatsAppText(text, time)
                               for text, time in tuple(zip(texts, times))]
+        STATS.count('messages_parsed', len(self.WhatsAppTexts))
+
+    def map_file(self):
+        """Return the file memory mapped read only, as bytes if empty."""
+        with open(self.path, 'rb') as file:
+            if os.fstat(file.fileno()).st_size == 0:
+                return(b'')
+            # The map stays valid after the file is closed
+            return(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def split_offsets(self, parts, start=0):
+        """Return byte offsets that cut the file into about parts pieces.
+
+        The first offset is start and every other one is the start of a
+        message header, so each piece holds whole messages. Pieces end
+        where the next one starts, the last one at the end of the file.
+        """
+        buffer = self.map_file()
+        offsets = [start]
+        for part in range(1, parts):
+            # ^ only matches at real line starts, not at the search position
+            header = MessageTokenizer.byte_header.search(
+                buffer, max(start + part * (len(buffer) - start) // parts,
+                            offsets[-1] + 1))
+            if header is None:
+                break
+            offsets.append(header.start())
+        return(offsets)
+
+    def iter_texts(self, watermark=None):
+        """Read the file line by line and yield one WhatsAppText at a time.
+
+        A line starting with a message header begins a new message and any
+        other line belongs to the message before it, so multi-line messages
+        are kept together. Only the message being built is held in memory.
+
+        If a watermark from a previous run is given, reading starts after
+        the message it points to, see find_watermark.
+        """
+        start = self.find_watermark(watermark) if watermark else 0
+        time_format = self.time_format()
+        for begin, end, stamp, text in self.iter_messages(start):
+            self.last = (begin, stamp, text)
+            STATS.count('messages_parsed')
+            yield(WhatsAppText(text, time_format.parse(stamp)))
+
+    def iter_messages(self, start=0):
+        """Yield (start, end, stamp, text) for each message in the file.
+
+        start and end are the byte offsets of the message in the file,
+        stamp is the time in its header and text is what follows the
+        header. Reading begins at byte offset start.
+        """
+        lines, stamp, begin = [], None, start
+        offset = start
+        with open(self.path, 'rb') as file:
+            file.seek(start)
+            for raw in file:
+                line = raw.decode(self.encoding)
+                if line.endswith('\r\n'):
+                    line = line[:-2] + '\n'
+                header = MESSAGE_HEADER.match(line)
+                if header:
+                    if stamp is not None:
+                        yield((begin, offset, stamp,
+                               ''.join(lines).rstrip('\n')))
+                    stamp, begin = header.group(1), offset
+                    lines = [line[header.end():]]
+                elif stamp is not None:
+                    lines.append(line)
+                offset += len(raw)
+        if stamp is not None:
+            yield((begin, offset, stamp, ''.join(lines).rstrip('\n')))
+
+    def find_last(self, contents):
+        """Return (None, stamp, text) of the last message in contents."""
+        end = len(contents)
+        while end > 0:
+            start = contents.rfind('\n', 0, end - 1) + 1
+            header = MESSAGE_HEADER.match(contents, start)
+            if header:
+                return((None, header.group(1),
+                        contents[header.end():].rstrip('\n')))
+            end = start
+        return(None)
+
+    @staticmethod
+    def hash_message(stamp, text):
+        """Return the SHA-256 of a message in hex."""
+        return(hashlib.sha256((stamp + ' - ' + text).encode('utf-8')).
+               hexdigest())
+
+    def watermark(self):
+        """Return a watermark for the last message read, or None.
+
+        It holds the byte offset the message starts at (None if unknown),
+        the time in its header and the hash of the message, so messages
+        sent in the same minute can be told apart.
+        """
+        if self.last is None:
+            return(None)
+        begin, stamp, text = self.last
+        return({'start': begin, 'time': stamp,
+                'hash': self.hash_message(stamp, text)})
+
+    def find_watermark(self, watermark):
+        """Return the byte offset just after the watermarked message.
+
+        First try the recorded offset directly. If the message there does
+        not match (the export was cut or edited) scan for it by hash. If it
+        is gone, start at the first message sent after its time.
+        """
+        def matches(stamp, text):
+            """Whether a message is the watermarked one."""
+            return(stamp == watermark['time'] and
+                   self.hash_message(stamp, text) == watermark['hash'])
+
+        if watermark.get('start') is not None:
+            for begin, end, stamp, text in self.iter_messages(
+                    watermark['start']):
+                if begin == watermark['start'] and matches(stamp, text):
+                    return(end)
+                break
+
+        # Fall back to reading from the start of the file
+        time_format = self.time_format()
+        time = time_format.parse(watermark['time'])
+        later = None
+        for begin, end, stamp, text in self.iter_messages():
+            if matches(stamp, text):
+                return(end)
+            if later is None and time_format.parse(stamp) > time:
+                later = begin
+        return(later if later is not None else os.path.getsize(self.path))
+
+
+class TimeFormat(object):
+    """Date format of the message headers in one export.
+
+    Exports are written in the format of the phone they come from, so the
+    same day can be 6/9/20, 09/06/2020 or 09.06.20, on a 12 or 24 hour
+    clock. TIME_STAMP matches all of them. The only thing left to work out
+    is whether the day or the month comes first, which detect does once
+    per export.
+
+    parse is a fixed field parser that decodes each distinct stamp only
+    once. Stamps with seconds keep them.
+    """
+
+    fields = re.compile(r'(\d+)[/.-](\d+)[/.-](\d+), (\d+):(\d+)'
+                        r'(?::(\d+))?(?:\D*([AaPp])\.? ?[Mm])?')
+    epoch = datetime(1970, 1, 1)
+    second = timedelta(seconds=1)
+
+    def __init__(self, day_first=False):
+        """Initialize the format and its cache of parsed stamps."""
+        self.day_first = day_first
+        self.times = dict()
+
+    @classmethod
+    def detect(cls, contents):
+        """Return the format of an export from its headers.
+
+        contents is the text of the export, or its undecoded bytes. A first
+        field over 12 has to be the day and a second one over 12 the
+        month, so headers are read until one of those turns up. That is
+        usually within the first two weeks of a chat, but a chat that
+        stays in the first 12 days of a month is read to the end. If no
+        header settles it, a 12 hour clock means a US export with the
+        month first, otherwise the day is.
+        """
+        header = (MessageTokenizer.header if isinstance(contents, str)
+                  else MessageTokenizer.byte_header)
+        seen = set()
+        twelve_hour = False
+        for match in header.finditer(contents):
+            stamp = match.group(1)
+            if stamp in seen:
+                continue
+            seen.add(stamp)
+            if not isinstance(stamp, str):
+                stamp = stamp.decode('utf-8')
+            fields = cls.fields.match(stamp).groups()
+            if int(fields[0]) > 12 or int(fields[1]) > 12:
+                return(cls(day_first=int(fields[0]) > 12))
+            twelve_hour = twelve_hour or fields[6] is not None
+        return(cls(day_first=not twelve_hour))
+
+    def parse(self, stamp):
+        """Return the datetime of a header stamp."""
+        try:
+            return(self.times[stamp])
+        except KeyError:
+            pass
+        first, second, year, hour, minute, seconds, half = \
+            self.fields.match(stamp).groups()
+        day, month = (first, second) if self.day_first else (second, first)
+        year, hour = int(year), int(hour)
+        if year < 100:
+            # Two digit years the way strptime reads %y
+            year += 1900 if year >= 69 else 2000
+        if half is not None:
+            hour = hour % 12 + (12 if half in 'Pp' else 0)
+        try:
+            time = datetime(year, int(month), int(day), hour, int(minute),
+                            int(seconds or 0))
+        except ValueError:
+            raise ValueError('time stamp %r does not fit the %s first date '
+                             'format of this export' %
+                             (stamp, 'day' if self.day_first else 'month'))
+        self.times[stamp] = time
+        return(time)
+
+    def seconds(self, stamps):
+        """Return the seconds since 1970 of each stamp in a list."""
+        return([(self.parse(stamp) - self.epoch) // self.second
+                for stamp in stamps])
+
+
+class MessageTokenizer(object):
+    """Split a whole export into messages in one pass.
+
+    Replaces the findall/search/split/sub scans in TextParser with a single
+    walk over the precompiled header pattern.
+    """
+
+    header = re.compile('^' + HEADER_START + '(' + TIME_STAMP + ') - ',
+                        re.MULTILINE)
+    # The same pattern for undecoded files, see MessageTable
+    byte_header = re.compile(header.pattern.encode('utf-8'), re.MULTILINE)
+
+    def __init__(self, time_format=None):
+        """Initialize with the TimeFormat of the export.
+
+        Without one, tokenize detects it from the contents it is given.
+        """
+        self.time_format = time_format
+
+    def parse_time(self, stamp):
+        """Return datetime of a header, parsing each distinct stamp once."""
+        return(self.time_format.parse(stamp))
+
+    def tokenize(self, contents):
+        """Yield (timestamp, sender, body, is_system) for each message.
+
+        A message runs from the end of its header to the start of the next
+        line that begins with a header. Sender and body are split as in
+        MessageTable, see split_message. Messages without a sender are
+        system messages with a sender of None.
+        """
+        if self.time_format is None:
+            self.time_format = TimeFormat.detect(contents)
+        previous = None
+        for match in self.header.finditer(contents):
+            if previous is not None:
+                yield(self.split(contents, previous, match.start()))
+            previous = match
+        if previous is not None:
+            yield(self.split(contents, previous, len(contents)))
+
+    def split(self, contents, header, end):
+        """Turn a header match and the text up to end into a message tuple."""
+        start = header.end()
+        while end > start and contents[end - 1] == '\n':
+            end -= 1
+        time = self.parse_time(header.group(1))
+        split, body, preprocess = self.split_message(contents, start, end)
+        if split < 0:
+            return((time, None, contents[start:end], True))
+        body = contents[body:end]
+        if preprocess:
+            body = WhatsAppText.preprocess_text(body)
+        return((time, contents[start:split], body, False))
+
+    @staticmethod
+    def split_message(contents, start, end, sep=': ', dash='- '):
+        """Find the sender and body of the message in contents[start:end].
+
+        Returns (split, body, preprocess). The sender runs from start to
+        split, and split is -1 for system messages, which have no sep. The
+        body runs from body to end. preprocess is whether the body has to
+        go through WhatsAppText.preprocess_text. As in WhatsAppText only
+        single-colon messages are preprocessed, and only "Name- " needs
+        any change. Pass byte sep and dash for undecoded contents.
+        """
+        split = contents.find(sep, start, end)
+        if split < 0:
+            return((-1, start, False))
+        body = split + len(sep)
+        return((split, body, contents.find(sep, body, end) < 0 and
+                contents.find(dash, body, end) >= 0))
 
 
 class WhatsAppText(object):
     """Class associated with a single Whatsapp message."""
 
-    msg, sender, alias = None, None, None
+    # No per-instance __dict__, there can be millions of these
+    __slots__ = ('time_sent', 'user_msg', 'sender', 'msg', 'alias')
 
     def __init__(self, text, time):
         """Initialize the class."""
         self.user_msg = bool(re.search(r': ', text))
         self.time_sent = time
+        self.sender, self.alias = None, None
         if self.user_msg:
             if len(re.split(r': ', text)) > 2:
                 self.msg = ': '.join(re.split(': ', text)[1:])
@@ -183,13 +805,15 @@ class WhatsAppText(object):
         else:
             self.msg = text
 
-    def preprocess_text(self, text):
+    @staticmethod
+    def preprocess_text(text):
         """Preprocess texts before putting them into Spacy model.
 
         For now the only thing I really want to do is fix a quirk where the
         format "Name- " thinks that Name- is one token.
         """
-        print(text)
+        if VERBOSE:
+            print(text)
         matches = re.findall(r'^([A-Z][a-z]+)\- |[\.\?\!] ([A-Z][a-z]+)\- ',
                              text)
         for match in matches:
@@ -202,34 +826,421 @@ class WhatsAppText(object):
         return(text)
 
 
+class MessageTable(object):
+    """Column store for the messages of one export.
+
+    Instead of one WhatsAppText per message the table keeps a few flat
+    columns: the time each message was sent as a numpy datetime64, an id
+    into a list of interned senders and the offsets of each body in the
+    export text. While parsing, each message only gets an id into a list
+    of the distinct header stamps. Once all are read decode_times parses
+    each of those once and turns the ids into times in one step.
+    Bodies are only copied out when a message is read, and only bodies
+    that were changed (preprocessed or anonymized) are stored separately.
+
+    Indexing or iterating gives MessageRow objects that behave like
+    WhatsAppText, so code written for a list of texts works unchanged.
+
+    contents may also be undecoded bytes, such as a memory mapped file,
+    with the encoding to decode them. Offsets are then byte offsets and
+    each slice is decoded when it is read.
+    """
+
+    def __init__(self, contents, encoding=None):
+        """Initialize an empty table over the export contents."""
+        self.contents = contents
+        self.encoding = encoding
+        if encoding is None:
+            self.sep, self.blank, self.dash = ': ', '\n', '- '
+        else:
+            self.sep, self.blank, self.dash = b': ', b'\r\n', b'- '
+        self.last = None  # (start, stamp, text) of the last message
+        self.times = None
+        self.stamp_ids = array('q')
+        self.stamps = dict()
+        self.sender_ids = array('l')
+        self.starts = array('q')
+        self.ends = array('q')
+        self.edits = dict()
+        self.senders = list()
+        self.sender_index = dict()
+
+    @classmethod
+    def from_contents(cls, contents, tokenizer=None, encoding=None):
+        """Parse a whole export into a table.
+
+        Messages are split the same way as in MessageTokenizer.tokenize.
+        Without a tokenizer the date format is detected from contents.
+        """
+        table = cls(contents, encoding)
+        tokenizer = tokenizer or MessageTokenizer()
+        if tokenizer.time_format is None:
+            tokenizer.time_format = TimeFormat.detect(contents)
+        header = tokenizer.header if encoding is None else \
+            tokenizer.byte_header
+        previous = None
+        for match in header.finditer(contents):
+            if previous is not None:
+                table.append(tokenizer, previous, match.start())
+            previous = match
+        if previous is not None:
+            table.append(tokenizer, previous, len(contents))
+            # Offsets into decoded text can't be used to seek in the file
+            table.last = (None if encoding is None else previous.start(),
+                          table.stamp(previous),
+                          table.text(previous.end(), len(contents)).
+                          rstrip('\n'))
+        table.decode_times(tokenizer.time_format)
+        return(table)
+
+    def append(self, tokenizer, header, end):
+        """Add the message from a header match to end of contents."""
+        contents = self.contents
+        start = header.end()
+        while end > start and contents[end - 1:end] in self.blank:
+            end -= 1
+        split, body, preprocess = tokenizer.split_message(
+            contents, start, end, self.sep, self.dash)
+        sender = -1 if split < 0 else self.intern(self.text(start, split))
+        start = body
+        index = len(self.starts)
+        stamp = header.group(1)
+        try:
+            self.stamp_ids.append(self.stamps[stamp])
+        except KeyError:
+            self.stamp_ids.append(self.stamps.setdefault(stamp,
+                                                         len(self.stamps)))
+        self.sender_ids.append(sender)
+        self.starts.append(start)
+        self.ends.append(end)
+        if preprocess:
+            self.set_msg(index, WhatsAppText.preprocess_text(
+                self.text(start, end)))
+
+    def decode_times(self, time_format):
+        """Fill the times column from the stamp ids of the messages."""
+        import numpy
+
+        stamps = [stamp if self.encoding is None else stamp.decode('utf-8')
+                  for stamp in self.stamps]
+        seconds = numpy.array(time_format.seconds(stamps), dtype='int64')
+        ids = numpy.frombuffer(self.stamp_ids, dtype='int64')
+        self.times = seconds[ids].astype('datetime64[s]')
+        self.stamp_ids, self.stamps = array('q'), dict()
+
+    def stamp(self, header):
+        """Return the time stamp of a header match as text."""
+        stamp = header.group(1)
+        return(stamp if self.encoding is None else stamp.decode('utf-8'))
+
+    def text(self, start, end):
+        """Return contents from start to end as text."""
+        text = self.contents[start:end]
+        if self.encoding is None:
+            return(text)
+        text = text.decode(self.encoding)
+        return(text.replace('\r\n', '\n') if '\r' in text else text)
+
+    def intern(self, sender):
+        """Return the id of sender, adding it if it is new."""
+        try:
+            return(self.sender_index[sender])
+        except KeyError:
+            self.sender_index[sender] = len(self.senders)
+            self.senders.append(sender)
+            return(len(self.senders) - 1)
+
+    def __len__(self):
+        """Return the number of messages."""
+        return(len(self.starts))
+
+    def __getitem__(self, index):
+        """Return a row for the message at index."""
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('message index out of range')
+        return(MessageRow(self, index))
+
+    def __iter__(self):
+        """Yield a row for each message in order."""
+        for index in range(len(self)):
+            yield(MessageRow(self, index))
+
+    def time_sent(self, index):
+        """Return the datetime of message index."""
+        return(self.times[index].item())
+
+    def sender(self, index):
+        """Return the sender of message index, None for system messages."""
+        sender = self.sender_ids[index]
+        return(None if sender < 0 else self.senders[sender])
+
+    def set_sender(self, index, sender):
+        """Replace the sender of message index."""
+        self.sender_ids[index] = -1 if sender is None else self.intern(sender)
+
+    def msg(self, index):
+        """Return the body of message index."""
+        try:
+            return(self.edits[index])
+        except KeyError:
+            return(self.text(self.starts[index], self.ends[index]))
+
+    def set_msg(self, index, msg):
+        """Replace the body of message index, keeping it only if changed."""
+        if msg == self.text(self.starts[index], self.ends[index]):
+            self.edits.pop(index, None)
+        else:
+            self.edits[index] = msg
+
+
+class TableChain(object):
+    """Several MessageTables read as one, in order."""
+
+    def __init__(self, tables):
+        """Chain tables."""
+        self.tables = list(tables)
+
+    def __len__(self):
+        """Return the number of messages in all tables."""
+        return(sum(len(table) for table in self.tables))
+
+    def __iter__(self):
+        """Yield a row for each message of each table."""
+        for table in self.tables:
+            yield from table
+
+
+class MessageRow(object):
+    """View of one message in a MessageTable with the WhatsAppText API."""
+
+    __slots__ = ('table', 'index')
+
+    def __init__(self, table, index):
+        """Point the row at message index of table."""
+        self.table = table
+        self.index = index
+
+    @property
+    def time_sent(self):
+        """Time the message was sent."""
+        return(self.table.time_sent(self.index))
+
+    @property
+    def user_msg(self):
+        """Whether the message was sent by a user."""
+        return(self.table.sender_ids[self.index] >= 0)
+
+    @property
+    def sender(self):
+        """Sender of the message, None for system messages."""
+        return(self.table.sender(self.index))
+
+    @sender.setter
+    def sender(self, sender):
+        self.table.set_sender(self.index, sender)
+
+    @property
+    def msg(self):
+        """Body of the message."""
+        return(self.table.msg(self.index))
+
+    @msg.setter
+    def msg(self, msg):
+        self.table.set_msg(self.index, msg)
+
+    @property
+    def alias(self):
+        """Aliases are kept in WhatsAppAnonymizer.aliasdict."""
+        return(None)
+
+
+class PIIScrubber(object):
+    """Replace phone numbers, emails, @mentions and links in one pass.
+
+    The patterns of the chosen kinds from PII_PATTERNS are compiled once
+    into a single alternation with one named group per kind, so each text
+    is scanned once however many kinds there are. Where two kinds could
+    match at the same place the one listed first in PII_PATTERNS wins.
+
+    Most messages have no digit, @ or link at all. A search for the kinds'
+    triggers finds those much faster than the full scanner, so only texts
+    that have one are scanned.
+    """
+
+    def __init__(self, kinds=None, replacements=None):
+        """Compile the scanner.
+
+        kinds is a list of keys of PII_PATTERNS, all of them by default.
+        replacements maps a kind to the text that replaces it, overriding
+        the default in PII_PATTERNS.
+        """
+        kinds = list(PII_PATTERNS) if kinds is None else kinds
+        unknown = set(kinds) - set(PII_PATTERNS)
+        if unknown:
+            raise ValueError('Unknown PII kinds: %s' %
+                             ', '.join(sorted(unknown)))
+        self.replacements = {kind: PII_PATTERNS[kind][1]
+                             for kind in kinds}
+        self.replacements.update(replacements or {})
+        kinds = [kind for kind in PII_PATTERNS if kind in self.replacements]
+        self.scanner = re.compile('|'.join(
+            '(?P<%s>%s)' % (kind, PII_PATTERNS[kind][0]) for kind in kinds))
+        self.trigger = re.compile('|'.join(
+            dict.fromkeys(PII_PATTERNS[kind][2] for kind in kinds)))
+
+    def replace(self, match):
+        """Return the replacement for a match of the scanner."""
+        STATS.count('pii_' + match.lastgroup)
+        return(self.replacements[match.lastgroup])
+
+    def scrub(self, text):
+        """Return text with every match replaced."""
+        if not self.replacements or not self.trigger.search(text):
+            return(text)
+        return(self.scanner.sub(self.replace, text))
+
+
+class EntityMatcher(object):
+    """Aho-Corasick automaton that finds known entities in a text.
+
+    Entities may be single names or several words ("First Last"). Matching
+    ignores case and only accepts matches that start and end on a word
+    boundary. Each text is scanned once, so the cost depends on the length
+    of the text and not on how many entities are known.
+    """
+
+    def __init__(self, entities):
+        """Build the automaton from an iterable of entity strings."""
+        self.goto = [dict()]  # Transitions out of each state
+        self.fail = [0]  # State to fall back to on a missing transition
+        self.lengths = [()]  # Lengths of entities ending in each state
+        for entity in entities:
+            if entity.strip():
+                self.add(entity.lower())
+        self.link()
+
+    def add(self, entity):
+        """Add a lowercased entity to the trie."""
+        state = 0
+        for char in entity:
+            if char not in self.goto[state]:
+                self.goto.append(dict())
+                self.fail.append(0)
+                self.lengths.append(())
+                self.goto[state][char] = len(self.goto) - 1
+            state = self.goto[state][char]
+        self.lengths[state] = (len(entity),)
+
+    def link(self):
+        """Set failure links breadth first, as in Aho-Corasick."""
+        queue = list(self.goto[0].values())
+        for state in queue:
+            for char, child in self.goto[state].items():
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[child] = self.goto[fallback].get(char, 0)
+                # Longest entity ending here first
+                self.lengths[child] = (self.lengths[child] +
+                                       self.lengths[self.fail[child]])
+                queue.append(child)
+
+    def spans(self, text):
+        """Return (start, end) of leftmost longest non-overlapping matches."""
+        if len(self.goto) == 1:
+            return(list())
+
+        folded = text.lower()
+        if len(folded) != len(text):
+            # Some characters lowercase to more than one, keep offsets
+            folded = ''.join(char if len(char.lower()) > 1 else char.lower()
+                             for char in text)
+
+        def is_word(i):
+            """Whether text[i] exists and is part of a word."""
+            return(0 <= i < len(text) and (text[i].isalnum() or
+                                           text[i] == '_'))
+
+        found = list()
+        state = 0
+        for i, char in enumerate(folded):
+            while state and char not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(char, 0)
+            if self.lengths[state] and not is_word(i + 1):
+                for length in self.lengths[state]:
+                    if not is_word(i - length):
+                        found.append((i + 1 - length, i + 1))
+
+        spans = list()
+        for start, end in sorted(found, key=lambda span: (span[0], -span[1])):
+            if not spans or start >= spans[-1][1]:
+                spans.append((start, end))
+        return(spans)
+
+    def replace(self, text, replacement='PERSON'):
+        """Replace every matched entity in text."""
+        pieces = list()
+        last = 0
+        for start, end in self.spans(text):
+            pieces.append(text[last:start])
+            pieces.append(replacement)
+            last = end
+        pieces.append(text[last:])
+        return(''.join(pieces))
+
+
 class Entity_Recognizer:
     """Replace indentifiers with anonymous tags/identities."""
 
-    def __init__(self, encryptor):
-        """Initialize nlp model, list of known entities, and list of names."""
-        self.nlp = spacy.load("en_core_web_sm")
+    def __init__(self, encryptor, model='en_core_web_sm', prefilter=True,
+                 pii=None, entlist=None):
+        """Initialize nlp model, list of known entities, and list of names.
+
+        Pass model=None when only the entity list is needed. With
+        prefilter=False every text goes through the model, see needs_model.
+        pii is the list of PIIScrubber kinds to replace, all by default.
+        entlist is the list of known entities, empty if not given.
+        """
+        if model:
+            import spacy
+            self.nlp = spacy.load(model, exclude=UNUSED_PIPES)
+        else:
+            self.nlp = None
 
         self.encryptor = encryptor
+        self.matcher = None
+        self.prefilter = prefilter
+        self.scrubber = PIIScrubber(pii)
 
-        if os.path.exists((KEY_DIR / "entlist.pickle")):
-            try:
-                with open((KEY_DIR / "entlist.pickle"), 'rb') as file:
-                    file = pickle.load(file)
-                    if file:
-                        self.decrypt_entlist(file)
-                    else:
-                        self.entlist = list()
-                        print("List is empty!")
-            except EOFError:
-                print("Entlist empty.")
-                self.entlist = list()
-                pass
-        else:
-            self.entlist = list()
+        self.entlist = dict.fromkeys(entlist or ())
+
+        self.names = self.load_names(NAMES_PATH)
 
-        self.names = list(pd.read_csv('/Users/RobertTeresi/Dropbox/'
-                                      'CoViD_ED_TF/listofnames.csv')['Name'])
-        self.names = [str(x).capitalize() for x in self.names]
+    def load_names(self, path):
+        """Return the names list as a frozenset.
+
+        The set is cached as a pickle next to the .csv and only rebuilt
+        when the .csv is newer than the cache.
+        """
+        cache = path.with_suffix('.pickle')
+        if (cache.exists() and
+                cache.stat().st_mtime >= path.stat().st_mtime):
+            STATS.count('names_cache_hits')
+            with open(cache, 'rb') as file:
+                return(pickle.load(file))
+
+        with open(path, newline='') as file:
+            names = frozenset(row['Name'].capitalize()
+                              for row in csv.DictReader(file))
+        try:
+            with open(cache, 'wb') as file:
+                pickle.dump(names, file)
+        except OSError:
+            print("Could not cache names list.")
+        return(names)
 
     def parse_entity(self, ent):
         """Make sure entity is person. Add to list if not on it."""
@@ -249,14 +1260,14 @@ class Entity_Recognizer:
                 if token.text.capitalize() in self.entlist:
                     pass
                 else:
-                    self.entlist.append(token.text)
+                    self.add_entity(token.text)
 
                 # If previous entity, check if full name is in list
                 if lastent:
                     if (' '.join([lastent[0], token.text.capitalize()])
                             not in self.entlist):
-                        self.entlist.append(' '.join([lastent[0],
-                                                     token.text.capitalize()]))
+                        self.add_entity(' '.join([lastent[0],
+                                                  token.text.capitalize()]))
                 lastent = [token.text.capitalize()]
 
                 if 'PERSON' in replacestring:
@@ -266,13 +1277,81 @@ class Entity_Recognizer:
 
         return(replacestring.strip())
 
+    def add_entity(self, entity):
+        """Add an entity to entlist, the matcher is rebuilt on next use.
+
+        entlist is a dict used as an insertion-ordered set, the values are
+        always None.
+        """
+        self.entlist[entity] = None
+        self.matcher = None
+
+    def get_matcher(self):
+        """Return the EntityMatcher for entlist, compiling it if needed."""
+        if self.matcher is None:
+            self.matcher = EntityMatcher(self.entlist)
+        return(self.matcher)
+
     def anonymize_text(self, text, iteration=None):
-        """Anonymize text."""
-        def obscure_phone_numbers(text):
-            """Replace phone numbers with NUMBER."""
-            return(re.sub(r'\+1 \(\d{3}\) \d{3}\-\d{4}', 'NUMBER', text))
+        """Anonymize text.
 
-        self.anontext = self.nlp(text)
+        The second iteration only matches entlist against the text, so it
+        does not run the model at all.
+        """
+        if iteration == 1:
+            return(self.replace_entities(text))
+        if iteration == 0 and not self.needs_model(text):
+            return(self.scrub_pii(text))
+        return(self.anonymize_doc(self.nlp(text), iteration))
+
+    def anonymize_texts(self, texts, iteration=None, batch_size=256,
+                        n_process=1):
+        """Anonymize an iterable of texts, yielding results in order.
+
+        Texts go through nlp.pipe in batches of batch_size, spread over
+        n_process processes. Each result is the same as anonymize_text.
+        """
+        if iteration == 1:
+            for text in texts:
+                yield(self.replace_entities(text))
+            return(None)
+
+        # Check each text once, both copies of the tee see the same answer
+        checked, queued = itertools.tee(
+            (text, iteration != 0 or self.needs_model(text))
+            for text in texts)
+        docs = self.nlp.pipe((text for text, model in queued if model),
+                             batch_size=batch_size, n_process=n_process)
+        for text, model in checked:
+            if model:
+                yield(self.anonymize_doc(next(docs), iteration))
+            else:
+                yield(self.scrub_pii(text))
+
+    def needs_model(self, text):
+        """Whether the model could find a PERSON in text.
+
+        WhatsApp placeholders such as "<Media omitted>" are passed over, and
+        so are texts with no capital letter outside of links and no word
+        from the names list, like "ok" or emoji. Known entities in them are
+        still replaced by the second pass, and PII by scrub_pii.
+        """
+        if not self.prefilter:
+            return(True)
+        STATS.count('prefilter_checked')
+        if text not in PLACEHOLDERS:
+            text = URL.sub('', text)
+            if (text != text.lower() or
+                    any(word.capitalize() in self.names
+                        for word in WORD.findall(text))):
+                return(True)
+        STATS.count('prefilter_skipped')
+        return(False)
+
+    def anonymize_doc(self, doc, iteration=None):
+        """Anonymize the text of a Doc that has already been through nlp."""
+        self.anontext = doc
+        STATS.count('ner_docs')
         text2 = str(self.anontext.text)
         reidx = 0  # Need to shift replace index after first entity replaced
         textlen = len(text2)
@@ -281,6 +1360,7 @@ class Entity_Recognizer:
         if iteration == 0:
             for ent in self.anontext.ents:
                 if ent.label_ == 'PERSON':
+                    STATS.count('entities_found')
                     replacer = self.parse_entity(ent)
                     text2 = (text2[:(ent.start_char + reidx)] +
                              replacer + text2[(ent.end_char + reidx):])
@@ -288,123 +1368,784 @@ class Entity_Recognizer:
                     # Following works because ents go from left to right.
                     reidx = len(text2) - textlen
 
-            return(obscure_phone_numbers(text2))
+            return(self.scrub_pii(text2))
         # In the second iteration
         elif iteration == 1:
-            for token in self.anontext:
-                if str(token.text).capitalize() in self.entlist:
-                    startchar = token.idx
-                    endchar = startchar + len(token.text) + 1
-                    text2 = (text2[:(startchar + reidx)] + 'PERSON' +
-                             text2[(endchar + reidx):])
-                    reidx = len(text2) - textlen
-            return(obscure_phone_numbers(text2))
+            return(self.replace_entities(text2))
         else:
             raise ValueError('Enter either 0 or 1 as the iteration parameter.')
 
+    def replace_entities(self, text):
+        """Replace every known entity in text with PERSON."""
+        return(self.scrub_pii(self.get_matcher().replace(text)))
+
+    def scrub_pii(self, text):
+        """Replace phone numbers, emails, mentions and links."""
+        return(self.scrubber.scrub(text))
+
     def delete_entlist(self):
         """Clear list so that names no longer exist."""
-        self.entlist = list()
-
-    def encrypt_entlist(self, entlist=None):
-        """Encrypt the entity list."""
-        if entlist:
-            self.entlist = [self.encryptor.encrypt(ent) for ent in entlist]
-        else:
-            self.entlist = [self.encryptor.encrypt(ent)
-                            for ent in self.entlist]
+        self.entlist = dict()
+        self.matcher = None
 
     def decrypt_entlist(self, entlist=None):
         """Decrypt the entity list.
 
         Have to pass instance of encrypt class for this to work.
         Not sure this is the best design.
+
+        Takes a blob made by Encryptor.encrypt_blob, or a list with one
+        RSA ciphertext per entity as saved by older versions.
         """
-        if entlist:
-            # Decrypt then use decode to switch from bytes to str
-            self.entlist = [self.encryptor.decrypt(ent).decode()
-                            for ent in entlist]
+        self.matcher = None
+        if entlist is None:
+            entlist = self.entlist
+        if isinstance(entlist, dict) and 'blob' in entlist:
+            self.entlist = dict.fromkeys(json.loads(self.encryptor.
+                                                    decrypt_blob(entlist)))
         else:
-            self.entlist = [self.encryptor.decrypt(ent).decode()
-                            for ent in self.entlist]
+            # Decrypt then use decode to switch from bytes to str
+            self.entlist = dict.fromkeys(ent.decode() for ent in
+                                         self.encryptor.decrypt_many(entlist))
+
+
+class RowWriter(object):
+    """Write output rows to a .csv as they are produced.
+
+    Rows go through a buffered file, gzip or zstd compressed if asked, so
+    nothing is kept in memory. The layout is what DataFrame.to_csv wrote:
+    an unnamed index column followed by sender, alias, msg and time.
+    """
+
+    columns = ['sender', 'alias', 'msg', 'time']
+    suffixes = {None: '', 'gzip': '.gz', 'zstd': '.zst'}
+
+    def __init__(self, path, compression=None, append=False, start_index=0):
+        """Open path for writing, or for appending if append is True."""
+        self.path = path
+        self.start_size = (os.path.getsize(path)
+                           if append and os.path.exists(path) else 0)
+        self.file = self.open(path, 'at' if append else 'wt', compression)
+        self.writer = csv.writer(self.file)
+        self.index = start_index
+        self.start_index = start_index
+        if not append:
+            self.writer.writerow([''] + self.columns)
+
+    @staticmethod
+    def open(path, mode, compression=None):
+        """Open a .csv in text mode, compressed or not."""
+        if compression is None:
+            return(open(path, mode, newline='', encoding='utf-8',
+                        buffering=1 << 20))
+        elif compression == 'gzip':
+            return(gzip.open(path, mode, newline='', encoding='utf-8'))
+        elif compression == 'zstd':
+            try:
+                import zstandard
+            except ImportError:
+                raise ImportError('zstd compression needs the zstandard '
+                                  'package: pip install zstandard')
+            return(zstandard.open(path, mode, newline='', encoding='utf-8'))
+        raise ValueError('compression must be None, "gzip" or "zstd".')
+
+    def write(self, sender, alias, msg, time):
+        """Write one row."""
+        self.writer.writerow([self.index, sender, alias, msg, time])
+        self.index += 1
+
+    def close(self):
+        """Flush and close the file."""
+        self.file.close()
+        STATS.count('bytes_written',
+                    os.path.getsize(self.path) - self.start_size)
+
+    def __enter__(self):
+        return(self)
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class Pipeline(object):
+    """Run stages on their own threads, joined by bounded queues.
+
+    A stage is a function that takes an iterable and returns an iterable,
+    like WhatsAppAnonymizer.anonymize_msgs. Each stage reads what the stage
+    before it yields, so all stages work at the same time. Items are
+    passed on in chunks, and a queue holds at most maxsize items, so a
+    fast stage blocks instead of running far ahead of a slow one. An
+    exception raised in a stage is raised again when iterating the
+    pipeline.
+
+    Stages given a name are profiled on their thread as pipeline_<name>
+    when profiling is on, see RunStats.profile.
+    """
+
+    chunk = 64
+    done = object()  # Put on a queue after the last chunk
+
+    def __init__(self, source, maxsize=1024, name=None):
+        """Start reading source on its own thread."""
+        self.maxsize = maxsize
+        self.error = None
+        self.queue = self.start(iter, source, name)
+
+    def then(self, stage, name=None):
+        """Add a stage after the last one and return the pipeline."""
+        self.queue = self.start(stage, self.drain(self.queue), name)
+        return(self)
+
+    def start(self, stage, items, name=None):
+        """Run stage over items on a thread and return its output queue."""
+        output = queue.Queue(max(1, self.maxsize // self.chunk))
+
+        def run():
+            """Put the output of stage on the queue chunk by chunk."""
+            chunk = list()
+            try:
+                with STATS.profile(name and 'pipeline_' + name):
+                    for item in stage(items):
+                        chunk.append(item)
+                        if len(chunk) == self.chunk:
+                            output.put(chunk)
+                            chunk = list()
+            except BaseException as error:
+                self.error = self.error or error
+            finally:
+                if chunk:
+                    output.put(chunk)
+                output.put(self.done)
+
+        threading.Thread(target=run, daemon=True).start()
+        return(output)
+
+    def drain(self, source):
+        """Yield items from a queue until its stage is done."""
+        while True:
+            chunk = source.get()
+            if chunk is self.done:
+                return(None)
+            yield from chunk
+
+    def __iter__(self):
+        """Yield what the last stage yields."""
+        yield from self.drain(self.queue)
+        if self.error is not None:
+            raise self.error
+
+
+class AliasAllocator(object):
+    """Hand out unique "First Last" aliases in constant time.
+
+    The pool is every first name in the names package times every last
+    name, hundreds of millions of aliases that are never built. The k-th
+    alias is the name at index (a * k + b) mod pool size, and a is coprime
+    with the pool size, so k -> index is a permutation. Aliases come out in
+    a shuffled order and never repeat, and nothing has to be searched.
+    a and b come from seed, so the same seed and the same number of aliases
+    drawn so far give the same next alias. used is a container of aliases
+    that are already taken, e.g. by older runs, which are skipped.
+    """
+
+    def __init__(self, used=(), seed=None, drawn=0):
+        """Initialize the permutation, seed is random if not given."""
+        self.seed = (random.SystemRandom().getrandbits(64) if seed is None
+                     else seed)
+        self.drawn = drawn
+        self.used = used
+        self.first = None
+        self.last = None
+        self.size = None
+        self.multiplier = None
+        self.offset = None
+
+    def load_pool(self):
+        """Read the names package's name lists and set up the permutation."""
+        import names
+
+        def read(*paths):
+            """Return the capitalized names in name files, without repeats."""
+            pool = dict()
+            for path in paths:
+                with open(path) as file:
+                    for line in file:
+                        pool[line.split(None, 1)[0].capitalize()] = None
+            return(list(pool))
+
+        self.first = read(names.FILES['first:male'],
+                          names.FILES['first:female'])
+        self.last = read(names.FILES['last'])
+        self.size = len(self.first) * len(self.last)
+        rng = random.Random(self.seed)
+        self.multiplier = rng.randrange(1, self.size)
+        while math.gcd(self.multiplier, self.size) != 1:
+            self.multiplier = rng.randrange(1, self.size)
+        self.offset = rng.randrange(self.size)
+
+    def allocate(self):
+        """Return an alias that has not been handed out before."""
+        if self.first is None:
+            self.load_pool()
+        while self.drawn < self.size:
+            index = (self.multiplier * self.drawn + self.offset) % self.size
+            self.drawn += 1
+            first, last = divmod(index, len(self.last))
+            alias = self.first[first] + ' ' + self.last[last]
+            if alias not in self.used:
+                return(alias)
+        raise RuntimeError('Ran out of aliases.')
+
+    def state(self):
+        """Return what is needed to carry on where this allocator stopped."""
+        return({'seed': self.seed, 'drawn': self.drawn})
+
+
+class StateStore(object):
+    """Senders, aliases and known entities kept in a SQLite database.
+
+    Replaces the pickles in KEY_DIR, which had to be read and written in
+    full on every run. Lookups use the tables' indexes and a run only
+    writes what it added, in one transaction that commit() ends. The
+    database uses write-ahead logging.
+
+    Sender names are never stored, senders are looked up by their HMAC
+    (see Encryptor.digest). Entities are stored encrypted with a Fernet
+    key that is kept encrypted with the public key, as in encrypt_blob.
+    """
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS senders (
+            digest TEXT PRIMARY KEY,
+            encrypted BLOB NOT NULL);
+        CREATE TABLE IF NOT EXISTS aliases (
+            encrypted BLOB PRIMARY KEY,
+            alias TEXT NOT NULL UNIQUE);
+        CREATE TABLE IF NOT EXISTS entities (
+            id INTEGER PRIMARY KEY,
+            digest TEXT NOT NULL UNIQUE,
+            entity BLOB NOT NULL);
+        CREATE TABLE IF NOT EXISTS meta (
+            name TEXT PRIMARY KEY,
+            value TEXT NOT NULL);
+        """
+
+    def __init__(self, path, encryptor):
+        """Open the database at path, creating it if needed."""
+        self.encryptor = encryptor
+        # A Pipeline encrypts senders on a thread of its own, but the store
+        # is only used by one thread at a time
+        self.connection = sqlite3.connect(str(path), check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.executescript(self.schema)
+        self.fernet = None
+        self.stored = set()  # Entities known to be in the database
+        self.used_aliases = StoredAliases(self.connection)
+
+    def get(self, name, default=None):
+        """Return the value saved under name, or default."""
+        row = self.connection.execute('SELECT value FROM meta WHERE name = ?',
+                                      (name,)).fetchone()
+        return(default if row is None else json.loads(row[0]))
+
+    def set(self, name, value):
+        """Save a JSON serializable value under name."""
+        self.connection.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                                (name, json.dumps(value)))
+
+    def senders(self, senders):
+        """Return the encrypted ids of the known senders as a dict."""
+        digests = {self.encryptor.digest(sender): sender
+                   for sender in senders}
+        found = dict()
+        keys = list(digests)
+        # Stay under SQLite's limit on the number of parameters
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            for digest, encrypted in self.connection.execute(
+                    'SELECT digest, encrypted FROM senders WHERE digest IN '
+                    '(%s)' % ', '.join('?' * len(chunk)), chunk):
+                found[digests[digest]] = encrypted
+        return(found)
+
+    def check_sender_mode(self, deterministic):
+        """Make sure the senders table holds the kind of ids this run makes.
+
+        RSA ciphertexts and keyed hashes can't be mixed in one store, so
+        the mode is saved with the first run and any other mode refused.
+        Stores from before the mode was saved are told apart by their ids,
+        hashes are text and ciphertexts bytes.
+        """
+        mode = 'deterministic' if deterministic else 'rsa'
+        saved = self.get('sender_mode')
+        if saved is None:
+            row = self.connection.execute(
+                'SELECT encrypted FROM senders LIMIT 1').fetchone()
+            if row is not None:
+                saved = 'deterministic' if isinstance(row[0], str) else 'rsa'
+        if saved is not None and saved != mode:
+            raise ValueError('The state store holds %s sender ids and this '
+                             'run would make %s ones. Use a separate key '
+                             'directory for each mode.' % (saved, mode))
+        if self.get('sender_mode') is None:
+            self.set('sender_mode', mode)
+
+    def add_senders(self, pairs):
+        """Save (sender, encrypted id) pairs."""
+        self.connection.executemany(
+            'INSERT OR IGNORE INTO senders VALUES (?, ?)',
+            ((self.encryptor.digest(sender), encrypted)
+             for sender, encrypted in pairs))
+
+    def alias(self, encrypted_id):
+        """Return the alias of an encrypted id, or None."""
+        row = self.connection.execute(
+            'SELECT alias FROM aliases WHERE encrypted = ?',
+            (encrypted_id,)).fetchone()
+        return(None if row is None else row[0])
+
+    def add_aliases(self, pairs):
+        """Save (encrypted id, alias) pairs."""
+        self.connection.executemany('INSERT INTO aliases VALUES (?, ?)',
+                                    pairs)
+
+    def get_fernet(self):
+        """Return the Fernet that encrypts entities, making its key once."""
+        from cryptography.fernet import Fernet
+
+        if self.fernet is None:
+            key = self.get('entity_key')
+            if key is None:
+                data_key = Fernet.generate_key()
+                self.set('entity_key', self.encryptor.encrypt(data_key).hex())
+            else:
+                data_key = self.encryptor.decrypt(bytes.fromhex(key))
+            self.fernet = Fernet(data_key)
+        return(self.fernet)
+
+    def entities(self):
+        """Return every saved entity, oldest first."""
+        rows = self.connection.execute(
+            'SELECT entity FROM entities ORDER BY id').fetchall()
+        if not rows:
+            return([])
+        fernet = self.get_fernet()
+        entities = [fernet.decrypt(row[0]).decode('utf-8') for row in rows]
+        self.stored.update(entities)
+        return(entities)
+
+    def add_entities(self, entities):
+        """Save the entities that are not saved yet."""
+        new = [entity for entity in entities if entity not in self.stored]
+        if not new:
+            return(None)
+        fernet = self.get_fernet()
+        self.connection.executemany(
+            'INSERT OR IGNORE INTO entities (digest, entity) VALUES (?, ?)',
+            ((self.encryptor.digest(entity),
+              fernet.encrypt(entity.encode('utf-8'))) for entity in new))
+        self.stored.update(new)
+
+    def commit(self):
+        """Make everything saved since the last commit permanent."""
+        self.connection.commit()
+
+    def rollback(self):
+        """Undo everything saved since the last commit."""
+        self.connection.rollback()
+        self.fernet = None  # Its key may have been rolled back too
+        self.stored.clear()
+
+
+class StoredAliases(object):
+    """The aliases in a StateStore, as a container for AliasAllocator."""
+
+    def __init__(self, connection):
+        """Look aliases up with connection."""
+        self.connection = connection
+
+    def __contains__(self, alias):
+        """Whether alias is taken."""
+        return(self.connection.execute(
+            'SELECT 1 FROM aliases WHERE alias = ?', (alias,)).fetchone()
+            is not None)
 
 
 class WhatsAppAnonymizer(object):
     """Main class that calls other classes and uploads data."""
 
-    aliasdict = {}
-    encryptdict = {}
-
-    def __init__(self, text_path, key_dir, data_dir):
-        """Initialize class."""
+    def __init__(self, text_path, key_dir, data_dir, stream=False,
+                 deterministic=False, compression=None, resume=False,
+                 model='en_core_web_sm', pipeline=False, queue_size=1024,
+                 prefilter=True, pii=None, alias_seed=None, shards=None,
+                 name=None, warm=None):
+        """Initialize class.
+
+        With stream=True the export is never held in memory at once. The
+        first anonymization pass is spooled to a temporary file and the
+        second pass runs as texts are read back in upload_file.
+
+        pipeline=True streams as well, but runs parsing, sender encryption
+        and the first pass on separate threads at the same time, and
+        reading the spool and the second pass alongside writing the output.
+        Stages are joined by a Pipeline of at most queue_size texts.
+
+        With deterministic=True senders are replaced by Encryptor's keyed
+        hash instead of RSA ciphertexts, see Encryptor.pseudonymize.
+
+        compression can be 'gzip' or 'zstd' to compress the output .csv.
+
+        With resume=True only messages after the watermark saved by the
+        last upload_file are parsed, anonymized and appended to the output.
+
+        model is the spaCy model to load, e.g. 'blank:en' to run without
+        a trained one. prefilter=False sends every text through it, see
+        Entity_Recognizer.needs_model. pii lists the kinds of PIIScrubber
+        to replace, all by default.
+
+        alias_seed seeds the AliasAllocator the first time aliases are
+        made. After that the seed saved with the state is used.
+
+        With shards=n the export is cut into n pieces at message headers
+        and the first pass runs on each in its own process, see
+        anonymize_shards. The output is the same as without shards.
+        Shards need the whole export parsed, so they are not used when
+        streaming.
+
+        name goes in front of the output and watermark file names, so
+        several exports can share data_dir. With text_path=None nothing is
+        parsed, only the model, keys and state are loaded. warm is another
+        WhatsAppAnonymizer whose model, keys and state are used instead of
+        loading them again, see AnonymizerServer.
+        """
         # Initialize paths needed
         self.text_path = text_path
         self.key_dir = key_dir
         self.data_dir = data_dir
+        self.stream = stream or pipeline
+        self.alias_seed = alias_seed
+        self.shards = None if self.stream else shards
+        self.model = model
+        self.prefilter = prefilter
+        self.pii = pii
+        self.pipeline = pipeline
+        self.queue_size = queue_size
+        self.spool = None
+        self.compression = compression
+        prefix = name + '_' if name else ''
+        self.output_path = Path(data_dir / (prefix +
+                                            'encrypted_whatsapp_msgs.csv' +
+                                            RowWriter.suffixes[compression]))
+        self.writer = None
+        self.batch_size = None
+        self.n_process = 1
+        self.watermark_path = Path(data_dir / (prefix + 'watermark.json'))
+        self.watermark = None
+        if resume and os.path.exists(self.watermark_path):
+            with open(self.watermark_path) as file:
+                self.watermark = json.load(file)
 
         # Initialize classes
-        self.textparser = TextParser(path=text_path)
-        self.textparser.parse_into_texts()
-        self.encryptor = Encryptor(key_dir=key_dir)
-        self.anonymizer = Entity_Recognizer(self.encryptor)
-
-        # Get entity dict if it exists
-        if os.path.exists(self.key_dir /
-                          'encrypted_dictionary.pickle'):
-            with open((KEY_DIR / 'encryptdict.pickle'), 'rb') as file:
-                self.encryptdict = pickle.load(file)
-            with open((KEY_DIR / 'aliasdict.pickle'), 'rb') as file:
-                self.aliasdict = pickle.load(file)
+        self.textparser = TextParser(path=text_path, stream=self.stream,
+                                     mapped=True)
+        with STATS.stage('parse'):
+            if self.watermark and not self.stream:
+                self.textparser.WhatsAppTexts = list(
+                    self.textparser.iter_texts(self.watermark))
+            elif not self.stream and not self.shards and text_path:
+                self.textparser.parse_into_texts()
+        if warm is not None:
+            self.encryptor, self.anonymizer = warm.encryptor, warm.anonymizer
+            self.state, self.aliases = warm.state, warm.aliases
+            self.encryptdict, self.aliasdict = warm.encryptdict, warm.aliasdict
+            return(None)
+        with STATS.stage('setup'):
+            self.encryptor = Encryptor(key_dir=key_dir,
+                                       deterministic=deterministic)
+            # With shards the model is only needed in the worker processes
+            self.anonymizer = Entity_Recognizer(self.encryptor,
+                                                model=None if self.shards
+                                                else model,
+                                                prefilter=prefilter, pii=pii,
+                                                entlist=())
+            self.load_state()
+
+    def load_state(self):
+        """Open the state store and load the entity list from it.
+
+        encryptdict and aliasdict only cache the senders and aliases this
+        run has looked up, the rest stays in the store.
+        """
+        self.encryptdict = dict()
+        self.aliasdict = dict()
+        self.state = StateStore(self.key_dir / 'state.sqlite3',
+                                self.encryptor)
+        if not self.state.get('imported', False):
+            try:
+                self.import_pickles()
+            except BaseException:
+                self.state.rollback()
+                raise
+        self.state.check_sender_mode(self.encryptor.deterministic)
+        self.anonymizer.entlist = dict.fromkeys(self.state.entities())
+        self.anonymizer.matcher = None
+        self.aliases = AliasAllocator(self.state.used_aliases,
+                                      **self.state.get('alias_state', {
+                                          'seed': self.alias_seed}))
+
+    def import_pickles(self):
+        """Move the state older versions kept in pickles into the store.
+
+        Everything goes in one transaction with the 'imported' flag, so an
+        import that fails leaves nothing behind and is tried again by the
+        next run. Older versions could give two senders the same alias.
+        The first one keeps it and the others get a new one.
+        """
+        key_dir = self.key_dir
+        if os.path.exists(key_dir / 'encryptdict.pickle'):
+            with open((key_dir / 'encryptdict.pickle'), 'rb') as file:
+                self.state.add_senders(pickle.load(file).items())
+        if (os.path.exists(key_dir / 'aliasstate.pickle') and
+                self.state.get('alias_state') is None):
+            with open((key_dir / 'aliasstate.pickle'), 'rb') as file:
+                self.state.set('alias_state', pickle.load(file))
+        if os.path.exists(key_dir / 'aliasdict.pickle'):
+            with open((key_dir / 'aliasdict.pickle'), 'rb') as file:
+                aliasdict = pickle.load(file)
+            aliases = AliasAllocator(self.state.used_aliases,
+                                     **self.state.get('alias_state', {
+                                         'seed': self.alias_seed}))
+            for encrypted_id, alias in aliasdict.items():
+                if (encrypted_id is None or
+                        self.state.alias(encrypted_id) is not None):
+                    continue
+                if alias in self.state.used_aliases:
+                    alias = aliases.allocate()
+                self.state.add_aliases([(encrypted_id, alias)])
+            self.state.set('alias_state', aliases.state())
+        if os.path.exists(key_dir / 'entlist.pickle'):
+            with open((key_dir / 'entlist.pickle'), 'rb') as file:
+                entlist = pickle.load(file)
+            if entlist:
+                self.anonymizer.decrypt_entlist(entlist)
+                self.state.add_entities(self.anonymizer.entlist)
+        self.state.set('imported', True)
+        self.state.commit()
+
+    def save_state(self):
+        """Save new entities and the alias state, and commit the store."""
+        self.state.add_entities(self.anonymizer.entlist)
+        self.state.set('alias_state', self.aliases.state())
+        self.state.commit()
 
     def encrypt_identities(self):
         """Encrypt the sender."""
-        for i in range(len(self.textparser.WhatsAppTexts)):
-            x = self.textparser.WhatsAppTexts[i].sender
-            if x is None:
-                continue
-            elif x in self.encryptdict.keys():
-                self.textparser.WhatsAppTexts[i].sender = self.encryptdict[x]
-            else:
-                encrypted_id = self.encryptor.encrypt(x)
-                self.encryptdict.update({x: encrypted_id})
-                self.textparser.WhatsAppTexts[i].sender = encrypted_id
+        # When streaming, senders are encrypted as texts come off the spool,
+        # with shards once the shards are done
+        if self.stream or self.shards:
+            return(None)
+        self.encrypt_texts(self.textparser.WhatsAppTexts)
+
+    def encrypt_texts(self, texts):
+        """Encrypt the sender of every text in a list or MessageTable."""
+        with STATS.stage('encrypt_identities'):
+            self.encrypt_new_senders(text.sender for text in texts)
+            for text in texts:
+                self.encrypt_sender(text)
+
+    def encrypt_new_senders(self, senders):
+        """Add every sender not in encryptdict to it in one batch.
+
+        Senders the store knows keep their id, the rest are encrypted
+        together and saved.
+        """
+        new = [sender for sender in dict.fromkeys(senders)
+               if sender is not None and sender not in self.encryptdict]
+        known = self.state.senders(new)
+        self.encryptdict.update(known)
+        new = [sender for sender in new if sender not in known]
+        encrypted = list(zip(new, self.encryptor.encrypt_ids(new)))
+        self.state.add_senders(encrypted)
+        self.encryptdict.update(encrypted)
+
+    def encrypt_sender(self, text):
+        """Replace the sender of a single text with its encrypted id."""
+        x = text.sender
+        if x is None:
+            return(None)
+        elif x in self.encryptdict.keys():
+            STATS.count('sender_cache_hits')
+            text.sender = self.encryptdict[x]
+        else:
+            self.encrypt_new_senders([x])
+            text.sender = self.encryptdict[x]
+
+    def encrypt_senders(self, texts):
+        """Encrypt the sender of each text and yield the text."""
+        for text in texts:
+            self.encrypt_sender(text)
+            yield(text)
 
     def create_alias(self, encrypted_id):
         """Create unique aliases for each encrypted identifier."""
-        def unique_name(namedict):
-            """Ensure aliases aren't repeated."""
-            name = names.get_full_name()
-            while name in namedict.items():
-                name = names.get_full_name()
-            return(name)
-
         if encrypted_id is None:
             self.aliasdict.update({encrypted_id: 'Whatsapp'})
         elif encrypted_id in self.aliasdict.keys():
             pass
         else:
-            self.aliasdict.update({encrypted_id: unique_name(self.aliasdict)})
+            alias = self.state.alias(encrypted_id)
+            if alias is None:
+                alias = self.aliases.allocate()
+                self.state.add_aliases([(encrypted_id, alias)])
+            self.aliasdict.update({encrypted_id: alias})
+
+    def anonymize_text_bodies(self, batch_size=None, n_process=1):
+        """Call anonymize function from encryptor class.
+
+        By default each message goes through the model on its own. Pass a
+        batch_size to feed messages through nlp.pipe in batches instead,
+        and n_process to use more than one core. The output is the same.
+        """
+        self.batch_size = batch_size
+        self.n_process = n_process
 
-    def anonymize_text_bodies(self):
-        """Call anonymize function from encryptor class."""
         # Run twice - first time builds dictionary, second time replaces based
         # on all recognized entities.
+        if self.shards:
+            self.anonymize_shards()
+            return(None)
+
+        if self.stream:
+            # Second pass happens in iter_texts once the dictionary is done
+            self.spool = tempfile.TemporaryFile()
+            texts = self.textparser.iter_texts(self.watermark)
+            if self.pipeline:
+                texts = Pipeline(texts, self.queue_size, 'parse').then(
+                    self.encrypt_senders, 'encrypt_identities').then(
+                    lambda texts: self.anonymize_msgs(texts, 0),
+                    'anonymize_pass_0')
+            else:
+                texts = self.anonymize_msgs(texts, 0)
+            with STATS.stage('anonymize_pass_0'):
+                for text in texts:
+                    pickle.dump(text, self.spool)
+            return(None)
+
         for j in range(0, 2):
-            for i in range(len(self.textparser.WhatsAppTexts)):
-                x = self.textparser.WhatsAppTexts[i].msg
-                self.textparser.WhatsAppTexts[i].msg = (self.anonymizer.
-                                                        anonymize_text(x, j))
+            with STATS.stage('anonymize_pass_%d' % j):
+                for text in self.anonymize_msgs(self.textparser.WhatsAppTexts,
+                                                j):
+                    continue  # anonymize_msgs updates each text in place
+
+    def anonymize_shards(self):
+        """Run both passes with the first one spread over processes.
+
+        Each worker parses its piece of the export and runs the first pass
+        on it, starting from the entity list this run started with. The
+        first pass only adds to the entity list and its output does not
+        depend on it, so adding each shard's new entities in shard order
+        gives the list a single process would have built. The second pass
+        then runs here over all shards with that list.
+        """
+        start = (self.textparser.find_watermark(self.watermark)
+                 if self.watermark else 0)
+        offsets = self.textparser.split_offsets(self.shards, start)
+        ends = offsets[1:] + [os.path.getsize(self.text_path)]
+        tables = list()
+        with STATS.stage('anonymize_pass_0'), ProcessPoolExecutor(
+                self.shards, initializer=init_batch_worker,
+                initargs=(self.key_dir, self.batch_size or 256,
+                          self.prefilter, self.pii,
+                          list(self.anonymizer.entlist), self.model)) as pool:
+            for table, entities, counters in pool.map(
+                    anonymize_shard, [(self.text_path, start, end,
+                                       self.textparser.time_format())
+                                      for start, end in zip(offsets, ends)]):
+                STATS.counters.update(counters)
+                tables.append((table, offsets[len(tables)]))
+                for entity in entities:
+                    if entity not in self.anonymizer.entlist:
+                        self.anonymizer.add_entity(entity)
+
+        self.textparser.WhatsAppTexts = TableChain(table
+                                                   for table, _ in tables)
+        for table, offset in reversed(tables):
+            if table.last is not None:
+                begin, stamp, text = table.last
+                self.textparser.last = (begin + offset, stamp, text)
+                break
+        with STATS.stage('anonymize_pass_1'):
+            for text in self.anonymize_msgs(self.textparser.WhatsAppTexts, 1):
+                continue  # anonymize_msgs updates each text in place
+        self.encrypt_texts(self.textparser.WhatsAppTexts)
+
+    def anonymize_msgs(self, texts, iteration):
+        """Anonymize the msg of each text in place and yield the text."""
+        if self.batch_size is None:
+            for text in texts:
+                text.msg = self.anonymizer.anonymize_text(text.msg, iteration)
+                yield(text)
+            return(None)
+
+        # nlp.pipe reads ahead of its output, tee holds the texts in between
+        texts, queued = itertools.tee(texts)
+        msgs = self.anonymizer.anonymize_texts((text.msg for text in queued),
+                                               iteration,
+                                               batch_size=self.batch_size,
+                                               n_process=self.n_process)
+        for text, msg in zip(texts, msgs):
+            text.msg = msg
+            yield(text)
+
+    def iter_texts(self):
+        """Yield the anonymized texts in order.
+
+        When streaming, texts are read back from the spool written by
+        anonymize_text_bodies and get their sender encrypted and the second
+        anonymization pass applied on the way out. A pipeline has already
+        encrypted the senders and does the rest on its own threads.
+        """
+        if not self.stream:
+            yield from self.textparser.WhatsAppTexts
+            return(None)
+
+        if self.spool is None:
+            for text in self.textparser.iter_texts(self.watermark):
+                self.encrypt_sender(text)
+                yield(text)
+            return(None)
+
+        if self.pipeline:
+            yield from Pipeline(self.read_spool(), self.queue_size,
+                                'read_spool').then(
+                lambda texts: self.anonymize_msgs(texts, 1),
+                'anonymize_pass_1')
+        else:
+            for text in self.read_spool():
+                text.msg = self.anonymizer.anonymize_text(text.msg, 1)
+                self.encrypt_sender(text)
+                yield(text)
+        self.spool.close()
+        self.spool = None
+
+    def read_spool(self):
+        """Yield the texts written to the spool by anonymize_text_bodies."""
+        self.spool.seek(0)
+        while True:
+            try:
+                yield(pickle.load(self.spool))
+            except EOFError:
+                return(None)
 
     def append_row(self, text):
-        """Append to text dataframe."""
-        self.textdf = self.textdf.append({'sender': text.sender,
-                                          'alias': self.aliasdict[text.sender],
-                                          'msg': text.msg,
-                                          'time': text.time_sent},
-                                         ignore_index=True)
+        """Write a text to the output file."""
+        STATS.count('messages_written')
+        self.writer.write(text.sender, self.aliasdict[text.sender],
+                          text.msg, text.time_sent)
 
     def upload_file(self, append=False):
-        """Create dataframe and upload it as a .csv.
+        """Write texts to the output .csv as they are produced.
 
         This will need some work. As of right not it won't do very well
         appending texts that were sent at the same time as the last text of
@@ -413,39 +2154,57 @@ class WhatsAppAnonymizer(object):
         """
         def quicktodate(timestr):
             """Convert datetimes from string back into datetime."""
-            return(datetime.strptime(timestr,  '%Y-%m-%d %H:%M:00'))
-
-        for text in self.textparser.WhatsAppTexts:
-            if append and (text.time_sent <
-                           quicktodate(self.old_data.iloc[-1]['time'])):
-                continue
-            self.create_alias(text.sender)
-            print(text.msg)
-            self.append_row(text)
-
-        # Save .csv
-        self.textdf.to_csv(self.data_dir / 'encrypted_whatsapp_msgs.csv')
-
-        # Save dictionaries
-        with open((KEY_DIR / 'encryptdict.pickle'), 'wb') as file:
-            pickle.dump(self.encryptdict, file)
-
-        with open((KEY_DIR / 'aliasdict.pickle'), 'wb') as file:
-            pickle.dump(self.aliasdict, file)
-
-        with open((KEY_DIR / 'entlist.pickle'), 'wb') as file:
-            self.anonymizer.encrypt_entlist()
-            pickle.dump(self.anonymizer.entlist,
-                        file)
+            return(datetime.strptime(timestr,  '%Y-%m-%d %H:%M:%S'))
+
+        self.writer = RowWriter(self.output_path, self.compression,
+                                append=append,
+                                start_index=self.old_rows if append else 0)
+        with STATS.stage('upload_file'), self.writer:
+            for text in self.iter_texts():
+                # Resumed runs only ever see texts after the watermark
+                if (append and not self.watermark and
+                        text.time_sent < quicktodate(self.old_time)):
+                    continue
+                self.create_alias(text.sender)
+                if VERBOSE:
+                    print(text.msg)
+                self.append_row(text)
+
+        self.save_state()
+        self.save_watermark()
+
+    def save_watermark(self):
+        """Record the last message written so a later run can resume."""
+        watermark = self.textparser.watermark()
+        if watermark is None:
+            return(None)
+        watermark['rows'] = self.writer.index
+        with open(self.watermark_path, 'w') as file:
+            json.dump(watermark, file)
+
+    def read_old_data(self):
+        """Find the row count and last time of the existing output file.
+
+        Reads one row at a time so the old file is never held in memory.
+        """
+        self.old_rows, self.old_time = 0, None
+        with RowWriter.open(self.output_path, 'rt',
+                            self.compression) as file:
+            reader = csv.reader(file)
+            header = next(reader)
+            for row in reader:
+                self.old_rows += 1
+                self.old_time = row[header.index('time')]
 
     def save_options(self):
         """Add to existing data if wanted."""
-        self.textdf = pd.DataFrame(columns=['sender',
-                                            'alias',
-                                            'msg',
-                                            'time'])
-        if os.path.exists(self.data_dir /
-                          'encrypted_whatsapp_msgs.csv'):
+        if self.watermark and os.path.exists(self.output_path):
+            # Resuming, new texts always go on the end of the old ones
+            self.old_rows = self.watermark['rows']
+            self.upload_file(append=True)
+            return(None)
+
+        if os.path.exists(self.output_path):
             console_msg = ('You already have encrypted messages saved.\n'
                            'Enter in 1 to overwrite the existing data\n'
                            'Enter in 2 to append to the existing data\n'
@@ -466,11 +2225,10 @@ class WhatsAppAnonymizer(object):
                 sys.exit()  # Exit the script without saving
 
             elif response == 2:
-                self.old_data = pd.read_csv(self.data_dir /
-                                            'encrypted_whatsapp_msgs.csv')
-                self.textdf = self.old_data
-                self.upload_file(append=True)
-                return(None)
+                self.read_old_data()
+                if self.old_time is not None:
+                    self.upload_file(append=True)
+                    return(None)
             elif response == 1:
                 print('You selected to overwrite your data. '
                       'Press 1 if you are sure you want to do this.\n'
@@ -484,14 +2242,455 @@ class WhatsAppAnonymizer(object):
         self.upload_file()
 
 
-def main():
+class BatchAnonymizer(WhatsAppAnonymizer):
+    """Anonymize many chat exports at once with shared identity state.
+
+    Files are spread over a pool of worker processes that each load the
+    spaCy model and keys once. Workers only run the two anonymization
+    passes. Sender encryption, aliases and the entity list are merged here
+    in sorted file order, so the same participant gets the same alias in
+    every chat and reruns give the same state.
+    """
+
+    def __init__(self, text_paths, key_dir, data_dir, processes=None,
+                 deterministic=False, compression=None, batch_size=256,
+                 prefilter=True, pii=None, alias_seed=None,
+                 model='en_core_web_sm'):
+        """Initialize class, text_paths is an iterable of chat exports."""
+        self.text_paths = sorted(Path(path) for path in text_paths)
+        self.alias_seed = alias_seed
+        self.prefilter = prefilter
+        self.pii = pii
+        self.model = model
+        self.key_dir = key_dir
+        self.data_dir = data_dir
+        self.processes = processes
+        self.compression = compression
+        self.batch_size = batch_size
+        self.writer = None
+
+        self.encryptor = Encryptor(key_dir=key_dir,
+                                   deterministic=deterministic)
+        self.anonymizer = Entity_Recognizer(self.encryptor, model=None,
+                                            entlist=())
+        self.load_state()
+
+    def run(self):
+        """Anonymize every file and save one output .csv per file."""
+        with ProcessPoolExecutor(self.processes,
+                                 initializer=init_batch_worker,
+                                 initargs=(self.key_dir,
+                                           self.batch_size,
+                                           self.prefilter,
+                                           self.pii,
+                                           list(self.anonymizer.entlist),
+                                           self.model)
+                                 ) as pool:
+            # map hands back results in the order of text_paths
+            for path, texts, entities, counters in pool.map(
+                    anonymize_batch_file, self.text_paths):
+                STATS.counters.update(counters)
+                with STATS.stage('merge'):
+                    self.merge(path, texts, entities)
+        self.save_state()
+
+    def merge(self, path, texts, entities):
+        """Add one file's results to the shared state and write them."""
+        for entity in entities:
+            if entity not in self.anonymizer.entlist:
+                self.anonymizer.add_entity(entity)
+
+        output_path = Path(self.data_dir / (path.stem +
+                                            '_encrypted_whatsapp_msgs.csv' +
+                                            RowWriter.suffixes[
+                                                self.compression]))
+        self.encrypt_new_senders(text.sender for text in texts)
+        with RowWriter(output_path, self.compression) as self.writer:
+            for text in texts:
+                self.encrypt_sender(text)
+                self.create_alias(text.sender)
+                self.append_row(text)
+
+
+def init_batch_worker(key_dir, batch_size, prefilter=True, pii=None,
+                      entlist=None, model='en_core_web_sm'):
+    """Load the model, keys and entity list once per worker process."""
+    global batch_worker
+    recognizer = Entity_Recognizer(Encryptor(key_dir=key_dir), model=model,
+                                   prefilter=prefilter, pii=pii,
+                                   entlist=entlist)
+    batch_worker = {'recognizer': recognizer,
+                    'entlist': dict(recognizer.entlist),
+                    'batch_size': batch_size}
+
+
+def anonymize_batch_file(path):
+    """Run both anonymization passes on one file in a worker process.
+
+    Every file starts from the entity list as it was saved, so results do
+    not depend on which worker got which file. Returns the path, the texts
+    with senders still in plain text, the entities the file added and the
+    worker's STATS counters for the file.
+    """
+    STATS.counters.clear()
+    recognizer = batch_worker['recognizer']
+    recognizer.entlist = dict(batch_worker['entlist'])
+    recognizer.matcher = None
+
+    textparser = TextParser(path=path, single_pass=True)
+    textparser.parse_into_texts()
+    texts = textparser.WhatsAppTexts
+    for j in range(0, 2):
+        msgs = recognizer.anonymize_texts([text.msg for text in texts], j,
+                                          batch_size=batch_worker[
+                                              'batch_size'])
+        for text, msg in zip(texts, list(msgs)):
+            text.msg = msg
+
+    entities = [entity for entity in recognizer.entlist
+                if entity not in batch_worker['entlist']]
+    return((path, texts, entities, dict(STATS.counters)))
+
+
+def anonymize_shard(shard):
+    """Parse one piece of an export and run the first pass on it.
+
+    Runs in a worker set up by init_batch_worker. shard is the path and
+    the byte offsets the piece starts and ends at, see
+    TextParser.split_offsets, and the TimeFormat of the whole export.
+    Returns the piece's MessageTable, the entities it added and the
+    worker's STATS counters for it.
+    """
+    path, start, end, time_format = shard
+    STATS.counters.clear()
+    recognizer = batch_worker['recognizer']
+    recognizer.entlist = dict(batch_worker['entlist'])
+    recognizer.matcher = None
+
+    with open(path, 'rb') as file:
+        file.seek(start)
+        texts = MessageTable.from_contents(file.read(end - start),
+                                           MessageTokenizer(time_format),
+                                           encoding='utf-8')
+    STATS.count('messages_parsed', len(texts))
+    msgs = recognizer.anonymize_texts([text.msg for text in texts], 0,
+                                      batch_size=batch_worker['batch_size'])
+    for text, msg in zip(texts, list(msgs)):
+        text.msg = msg
+
+    entities = [entity for entity in recognizer.entlist
+                if entity not in batch_worker['entlist']]
+    return((texts, entities, dict(STATS.counters)))
+
+
+def expand_paths(pattern):
+    """Return chat exports in a directory, or the files matching a glob."""
+    if os.path.isdir(pattern):
+        pattern = os.path.join(pattern, '*.txt')
+    return(sorted(glob.glob(pattern)))
+
+
+class AnonymizerServer(http.server.HTTPServer):
+    """Local HTTP service that keeps the model, keys and state loaded.
+
+    Loading the spaCy model and the keys takes longer than anonymizing
+    most exports. The server does it once and then anonymizes whatever it
+    is sent, one request at a time, with the same state store as runs
+    from the command line. Requests and replies are JSON:
+
+    POST /file {"path": ..., "resume": false} anonymizes an export on this
+        machine into DATA_DIR/<stem>_encrypted_whatsapp_msgs.csv. An
+        existing output is overwritten unless resuming, there is no one
+        to ask.
+    POST /messages {"text": ...} anonymizes the text of an export and
+        replies with its rows instead of writing them, RSA encrypted
+        senders as hex.
+    GET /status replies with the STATS report so far.
+    POST /shutdown stops the server.
+
+    POST requests must be sent as application/json. A web page can only
+    send that to another origin after a CORS preflight, which the server
+    never answers, so pages open in a local browser can't use it.
+    """
+
+    def __init__(self, key_dir, data_dir, host='127.0.0.1', port=8765,
+                 batch_size=None, **options):
+        """Load everything a run needs, options go to WhatsAppAnonymizer."""
+        super().__init__((host, port), AnonymizerRequestHandler)
+        self.key_dir = key_dir
+        self.data_dir = data_dir
+        self.batch_size = batch_size
+        self.warm = WhatsAppAnonymizer(None, key_dir, data_dir, **options)
+
+    def anonymize_file(self, path, resume=False):
+        """Anonymize one export and write it out, return where to."""
+        path = Path(path)
+        anonymizer = WhatsAppAnonymizer(path, self.key_dir, self.data_dir,
+                                        compression=self.warm.compression,
+                                        resume=resume, name=path.stem,
+                                        warm=self.warm)
+        anonymizer.encrypt_identities()
+        anonymizer.anonymize_text_bodies(batch_size=self.batch_size)
+        if anonymizer.watermark and os.path.exists(anonymizer.output_path):
+            anonymizer.save_options()  # Appends without asking
+        else:
+            anonymizer.upload_file()
+        # Rows written for this request, not counting earlier runs
+        return({'output': str(anonymizer.output_path),
+                'rows': (anonymizer.writer.index -
+                         anonymizer.writer.start_index)})
+
+    def anonymize_messages(self, contents):
+        """Anonymize the text of an export and return its rows."""
+        anonymizer = WhatsAppAnonymizer(None, self.key_dir, self.data_dir,
+                                        warm=self.warm)
+        with STATS.stage('parse'):
+            table = MessageTable.from_contents(contents)
+            STATS.count('messages_parsed', len(table))
+        anonymizer.textparser.WhatsAppTexts = table
+        anonymizer.encrypt_identities()
+        anonymizer.anonymize_text_bodies(batch_size=self.batch_size)
+        rows = list()
+        for text in table:
+            anonymizer.create_alias(text.sender)
+            STATS.count('messages_written')
+            sender = text.sender
+            rows.append({'sender': sender.hex() if isinstance(sender, bytes)
+                         else sender,
+                         'alias': anonymizer.aliasdict[text.sender],
+                         'msg': text.msg, 'time': str(text.time_sent)})
+        anonymizer.save_state()
+        return(rows)
+
+
+class AnonymizerRequestHandler(http.server.BaseHTTPRequestHandler):
+    """Answer the requests sent to an AnonymizerServer."""
+
+    def do_GET(self):
+        """Reply to GET /status."""
+        if self.path == '/status':
+            self.reply(200, STATS.report())
+        else:
+            self.reply(404, {'error': 'no such route: ' + self.path})
+
+    def do_POST(self):
+        """Reply to POST /file, /messages and /shutdown."""
+        content_type = self.headers.get('Content-Type', '')
+        if content_type.split(';')[0].strip().lower() != 'application/json':
+            self.reply(415, {'error': 'requests must be application/json'})
+            return(None)
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            body = json.loads(self.rfile.read(length) or b'{}')
+            if self.path == '/file':
+                result = self.server.anonymize_file(body['path'],
+                                                    body.get('resume',
+                                                             False))
+            elif self.path == '/messages':
+                result = {'rows': self.server.anonymize_messages(
+                    body['text'])}
+            elif self.path == '/shutdown':
+                # shutdown waits for this request, so it can't run here
+                threading.Thread(target=self.server.shutdown).start()
+                result = {'stopping': True}
+            else:
+                self.reply(404, {'error': 'no such route: ' + self.path})
+                return(None)
+        except (KeyError, TypeError, ValueError, OSError) as error:
+            self.reply(400, {'error': repr(error)})
+            return(None)
+        except Exception as error:
+            self.reply(500, {'error': repr(error)})
+            return(None)
+        self.reply(200, result)
+
+    def reply(self, status, result):
+        """Send result as JSON."""
+        body = json.dumps(result).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        """Only log requests with --verbose."""
+        if VERBOSE:
+            super().log_message(format, *args)
+
+
+def call_server(url, route, payload=None):
+    """Send one request to an AnonymizerServer and return its reply.
+
+    Sends a GET without a payload and a POST with one. Errors the server
+    replies with are raised as RuntimeError.
+    """
+    data = None if payload is None else json.dumps(payload).encode('utf-8')
+    request = urllib.request.Request(url.rstrip('/') + route, data=data,
+                                     headers={'Content-Type':
+                                              'application/json'})
+    # The server is local, never send requests through a proxy
+    opener = urllib.request.build_opener(urllib.request.ProxyHandler({}))
+    try:
+        with opener.open(request) as response:
+            return(json.load(response))
+    except urllib.error.HTTPError as error:
+        raise RuntimeError('%s %s: %s' % (route, error.code,
+                                          json.load(error)['error']))
+
+
+def parse_args(argv=None):
+    """Parse command line options."""
+    parser = argparse.ArgumentParser(description='Parse and anonymize '
+                                     'WhatsApp chat exports.')
+    parser.add_argument('--text', type=Path, default=TEXT_PATH,
+                        help='chat export to anonymize')
+    parser.add_argument('--batch', metavar='DIR_OR_GLOB',
+                        help='anonymize every export in a directory or '
+                        'matching a glob, in parallel')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='worker processes for --batch '
+                        '(default: one per core)')
+    parser.add_argument('--batch-size', type=int, default=None,
+                        help='messages per nlp.pipe batch')
+    parser.add_argument('--n-process', type=int, default=1,
+                        help='processes for nlp.pipe, messages go through '
+                        'it in batches of --batch-size (default: 256)')
+    parser.add_argument('--stream', action='store_true',
+                        help='read the export incrementally')
+    parser.add_argument('--pipeline', action='store_true',
+                        help='stream, running the stages on threads at '
+                        'the same time')
+    parser.add_argument('--queue-size', type=int, default=1024,
+                        help='texts held between pipeline stages '
+                        '(default: 1024)')
+    parser.add_argument('--no-prefilter', dest='prefilter',
+                        action='store_false',
+                        help='send every message through the model, even '
+                        'ones that cannot contain a name')
+    parser.add_argument('--pii', nargs='*', choices=list(PII_PATTERNS),
+                        help='kinds of personal data to replace in message '
+                        'text (default: all)')
+    parser.add_argument('--alias-seed', type=int,
+                        help='seed for the order aliases are handed out in, '
+                        'only used before any aliases exist')
+    parser.add_argument('--shards', type=int,
+                        help='split the export into this many pieces and '
+                        'run the model on each in its own process')
+    parser.add_argument('--model', default='en_core_web_sm',
+                        help='spaCy model to load (default: en_core_web_sm)')
+    parser.add_argument('--serve', action='store_true',
+                        help='keep the model and keys loaded and anonymize '
+                        'exports sent over HTTP, see AnonymizerServer')
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='address for --serve (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=8765,
+                        help='port for --serve (default: 8765)')
+    parser.add_argument('--connect', metavar='URL',
+                        help='send --text, or every file in --batch, to a '
+                        'server started with --serve')
+    parser.add_argument('--resume', action='store_true',
+                        help='only process messages after the last run')
+    parser.add_argument('--deterministic', action='store_true',
+                        help='pseudonymize senders with a keyed hash')
+    parser.add_argument('--compression', choices=['gzip', 'zstd'],
+                        help='compress the output .csv')
+    parser.add_argument('--report', type=Path, default=None,
+                        help='where to write the JSON run report '
+                        '(default: DATA_DIR/run_report.json)')
+    parser.add_argument('--profile', metavar='DIR',
+                        help='cProfile every stage into DIR, same as '
+                        'setting WHATSAPP_ANONYMIZE_PROFILE=DIR. With '
+                        '--pipeline each stage thread is profiled as '
+                        'pipeline_<stage>.prof')
+    parser.add_argument('--verbose', action='store_true',
+                        help='print every message as it is processed')
+    args = parser.parse_args(argv)
+    if args.shards and (args.stream or args.pipeline):
+        parser.error('--shards can not be used with --stream or --pipeline')
+    if args.n_process > 1 and args.batch_size is None:
+        # Only nlp.pipe uses more than one process
+        args.batch_size = 256
+    return(args)
+
+
+def main(argv=None):
     """Control execution of class functions."""
+    global VERBOSE
+    args = parse_args(argv)
+    VERBOSE = args.verbose
+    if args.profile:
+        STATS.profile_dir = args.profile
+    if args.connect:
+        return(run_client(args))
+    try:
+        run(args)
+    finally:
+        STATS.save(args.report or DATA_DIR / 'run_report.json')
+
+
+def run(args):
+    """Run the anonymizer as set up on the command line."""
     global anonymizer
-    anonymizer = WhatsAppAnonymizer(TEXT_PATH, KEY_DIR, DATA_DIR)
+    if args.serve:
+        server = AnonymizerServer(KEY_DIR, DATA_DIR, host=args.host,
+                                  port=args.port,
+                                  batch_size=args.batch_size,
+                                  deterministic=args.deterministic,
+                                  compression=args.compression,
+                                  model=args.model,
+                                  prefilter=args.prefilter,
+                                  pii=args.pii,
+                                  alias_seed=args.alias_seed)
+        print('Serving on http://%s:%d' % server.server_address)
+        with server:
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+        return(None)
+
+    if args.batch:
+        anonymizer = BatchAnonymizer(expand_paths(args.batch), KEY_DIR,
+                                     DATA_DIR, processes=args.processes,
+                                     deterministic=args.deterministic,
+                                     compression=args.compression,
+                                     batch_size=args.batch_size or 256,
+                                     prefilter=args.prefilter,
+                                     pii=args.pii,
+                                     alias_seed=args.alias_seed,
+                                     model=args.model)
+        anonymizer.run()
+        return(None)
+
+    anonymizer = WhatsAppAnonymizer(args.text, KEY_DIR, DATA_DIR,
+                                    stream=args.stream,
+                                    deterministic=args.deterministic,
+                                    compression=args.compression,
+                                    resume=args.resume,
+                                    pipeline=args.pipeline,
+                                    queue_size=args.queue_size,
+                                    prefilter=args.prefilter,
+                                    pii=args.pii,
+                                    alias_seed=args.alias_seed,
+                                    shards=args.shards,
+                                    model=args.model)
     anonymizer.encrypt_identities()
-    anonymizer.anonymize_text_bodies()
+    anonymizer.anonymize_text_bodies(batch_size=args.batch_size,
+                                     n_process=args.n_process)
     anonymizer.save_options()
 
 
+def run_client(args):
+    """Send the exports named on the command line to a running server."""
+    paths = expand_paths(args.batch) if args.batch else [args.text]
+    for path in paths:
+        result = call_server(args.connect, '/file',
+                             {'path': os.path.abspath(path),
+                              'resume': args.resume})
+        print('%s: %d rows in %s' % (path, result['rows'],
+                                     result['output']))
+
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Compare the old US phone number pattern with PIIScrubber.
+
+Both run over the message bodies of a synthetic export, see
+synthetic_chat.py.
+
+Usage: python benchmarks/bench_scrubber.py [n_messages]
+"""
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.dirname(__file__))
+from WhatsApp_Anonymize.WhatsApp_Anonymize import (  # noqa: E402
+    STATS, MessageTokenizer, PIIScrubber)
+from synthetic_chat import generate_messages  # noqa: E402
+
+# What Entity_Recognizer.obscure_phone_numbers used to replace
+US_PHONE_NUMBER = re.compile(r'\+1 \(\d{3}\) \d{3}\-\d{4}')
+
+
+def time_scrub(scrub, bodies, repeat=3):
+    """Return the best time in seconds to scrub every body."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for body in bodies:
+            scrub(body)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return(best)
+
+
+def main():
+    """Print throughput of both scrubbers and what PIIScrubber replaced."""
+    n_messages = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    contents = '\n\n'.join(generate_messages(n_messages))
+    bodies = [body for _, _, body, _ in MessageTokenizer().tokenize(contents)]
+    megabytes = sum(len(body) for body in bodies) / 2 ** 20
+
+    scrubber = PIIScrubber()
+    old = time_scrub(lambda body: US_PHONE_NUMBER.sub('NUMBER', body),
+                     bodies)
+    STATS.counters.clear()
+    new = time_scrub(scrubber.scrub, bodies, repeat=1)
+    found = {name[4:]: count for name, count in STATS.counters.items()
+             if name.startswith('pii_')}
+    new = min(new, time_scrub(scrubber.scrub, bodies))
+
+    print('messages:     %d (%.1f MB of text)' % (n_messages, megabytes))
+    print('US phone:     %.3fs (%.0f msg/s, %.1f MB/s)' %
+          (old, n_messages / old, megabytes / old))
+    print('PIIScrubber:  %.3fs (%.0f msg/s, %.1f MB/s)' %
+          (new, n_messages / new, megabytes / new))
+    print('replaced:     %s' % ', '.join('%s %d' % item
+                                         for item in sorted(found.items())))
+
+
+if __name__ == '__main__':
+    main()
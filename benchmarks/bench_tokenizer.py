@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Compare TextParser's regex scans with the single-pass MessageTokenizer.
+
+Usage: python benchmarks/bench_tokenizer.py [n_messages]
+"""
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.dirname(__file__))
+from WhatsApp_Anonymize.WhatsApp_Anonymize import TextParser  # noqa: E402
+from synthetic_chat import write_export  # noqa: E402
+
+
+def time_parser(path, single_pass, repeat=3):
+    """Return the best time to parse path in seconds and the texts."""
+    best = None
+    for _ in range(repeat):
+        parser = TextParser(path, single_pass=single_pass)
+        start = time.perf_counter()
+        parser.parse_into_texts()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return(best, parser.WhatsAppTexts)
+
+
+def main():
+    """Print throughput of both parsing paths."""
+    n_messages = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    with tempfile.NamedTemporaryFile(suffix='.txt', delete=False) as file:
+        pass
+    # A byte order mark checks the first message is not lost
+    write_export(file.name, n_messages, bom=True)
+    try:
+        legacy, old = time_parser(file.name, single_pass=False)
+        single, new = time_parser(file.name, single_pass=True)
+    finally:
+        os.remove(file.name)
+
+    same = all((a.time_sent, a.sender, a.msg.rstrip('\n')) ==
+               (b.time_sent, b.sender, b.msg) for a, b in zip(old, new))
+    print('messages:    %d' % n_messages)
+    print('regex scans: %.3fs (%.0f msg/s)' % (legacy, n_messages / legacy))
+    print('single pass: %.3fs (%.0f msg/s)' % (single, n_messages / single))
+    print('speedup:     %.2fx' % (legacy / single))
+    print('identical:   %s' % (same and len(old) == len(new)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Time each stage of WhatsAppAnonymizer on synthetic exports.
+
+Every size runs in its own process so peak RSS is per run. For each stage
+the wall time, throughput and peak RSS so far are reported. Use
+--model blank:en to benchmark without a trained model (no entities are
+found, so the NER stages only measure tokenization).
+
+Usage: python benchmarks/run_benchmarks.py [--sizes 1000 10000 ...]
+"""
+import argparse
+import contextlib
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.dirname(__file__))
+import WhatsApp_Anonymize.WhatsApp_Anonymize as wa  # noqa: E402
+from synthetic_chat import write_export, write_names  # noqa: E402
+
+
+def peak_rss_mb():
+    """Return peak resident memory of this process in MB."""
+    return(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)
+
+
+def run_size(n_messages, model, batch_size, single_pass, mapped=False):
+    """Run every stage in a temporary directory and return the timings."""
+    with tempfile.TemporaryDirectory() as workdir:
+        return(run_stages(Path(workdir), n_messages, model, batch_size,
+                          single_pass, mapped))
+
+
+def run_stages(workdir, n_messages, model, batch_size, single_pass,
+               mapped=False):
+    """Run every stage on one synthetic export in workdir."""
+    export = workdir / 'chat.txt'
+    write_export(export, n_messages)
+    write_names(workdir / 'listofnames.csv')
+    wa.KEY_DIR = workdir / 'keys'
+    wa.NAMES_PATH = workdir / 'listofnames.csv'
+
+    results = {'messages': n_messages, 'model': model,
+               'batch_size': batch_size, 'single_pass': single_pass,
+               'mapped': mapped,
+               'export_mb': export.stat().st_size / 2 ** 20, 'stages': {}}
+
+    @contextlib.contextmanager
+    def stage(name):
+        """Time a stage and record it in results."""
+        start = time.perf_counter()
+        yield(None)
+        elapsed = time.perf_counter() - start
+        results['stages'][name] = {'seconds': elapsed,
+                                   'msgs_per_s': n_messages / elapsed,
+                                   'peak_rss_mb': peak_rss_mb()}
+
+    with stage('setup'):
+        # stream=True so the constructor doesn't parse, that is timed next
+        anonymizer = wa.WhatsAppAnonymizer(export, wa.KEY_DIR, workdir,
+                                           stream=True, model=model)
+        anonymizer.stream = False
+        anonymizer.batch_size = batch_size
+        anonymizer.textparser = wa.TextParser(export,
+                                              single_pass=single_pass,
+                                              mapped=mapped)
+    with stage('parse_into_texts'):
+        anonymizer.textparser.parse_into_texts()
+    with stage('encrypt_identities'):
+        anonymizer.encrypt_identities()
+    texts = anonymizer.textparser.WhatsAppTexts
+    with stage('anonymize_pass_0'):
+        for text in anonymizer.anonymize_msgs(texts, 0):
+            continue
+    with stage('anonymize_pass_1'):
+        for text in anonymizer.anonymize_msgs(texts, 1):
+            continue
+    with stage('upload_file'):
+        anonymizer.upload_file()
+    results['output_mb'] = anonymizer.output_path.stat().st_size / 2 ** 20
+    return(results)
+
+
+def print_results(results):
+    """Print one run as a table."""
+    print('\n%d messages (%.1f MB export, model %s)' %
+          (results['messages'], results['export_mb'], results['model']))
+    print('%-20s %10s %12s %12s' % ('stage', 'seconds', 'msg/s',
+                                    'peak RSS MB'))
+    for name, stage in results['stages'].items():
+        print('%-20s %10.3f %12.0f %12.1f' % (name, stage['seconds'],
+                                              stage['msgs_per_s'],
+                                              stage['peak_rss_mb']))
+
+
+def parse_args(argv=None):
+    """Parse command line options."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[1000, 10000, 100000],
+                        help='numbers of messages, e.g. 1000 1000000')
+    parser.add_argument('--model', default='en_core_web_sm',
+                        help='spaCy model, blank:en needs no download')
+    parser.add_argument('--batch-size', type=int, default=None,
+                        help='nlp.pipe batch size (default per message)')
+    parser.add_argument('--single-pass', action='store_true',
+                        help='parse into a MessageTable in one scan')
+    parser.add_argument('--mapped', action='store_true',
+                        help='parse the memory mapped file, implies '
+                        '--single-pass')
+    parser.add_argument('--output', help='write results as JSON here')
+    parser.add_argument('--child', action='store_true',
+                        help=argparse.SUPPRESS)
+    return(parser.parse_args(argv))
+
+
+def main(argv=None):
+    """Run every size in a fresh process and report the results."""
+    args = parse_args(argv)
+    if args.child:
+        print(json.dumps(run_size(args.sizes[0], args.model,
+                                  args.batch_size, args.single_pass,
+                                  args.mapped)))
+        return(None)
+
+    runs = list()
+    for size in args.sizes:
+        command = [sys.executable, __file__, '--child', '--sizes', str(size),
+                   '--model', args.model]
+        if args.batch_size:
+            command += ['--batch-size', str(args.batch_size)]
+        if args.single_pass:
+            command.append('--single-pass')
+        if args.mapped:
+            command.append('--mapped')
+        output = subprocess.run(command, check=True, stdout=subprocess.PIPE,
+                                universal_newlines=True).stdout
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+        print_results(runs[-1])
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(runs, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Generate synthetic WhatsApp exports for benchmarking.
+
+Messages use the "6/9/20, 3:08 PM - Sender: text" headers that
+TextParser.parse_times expects, separated by blank lines, with times that
+only move forward. The mix includes system messages, multi-line messages,
+the "Name- " quirk, phone numbers, emails, links, @mentions and media
+placeholders.
+
+Usage: python benchmarks/synthetic_chat.py n_messages path
+"""
+import random
+import sys
+from datetime import datetime, timedelta
+
+FIRST_NAMES = ['Alice', 'Bob', 'Carol', 'David', 'Erin', 'Frank', 'Grace',
+               'Heidi', 'Ivan', 'Judy', 'Mallory', 'Niaj', 'Olivia',
+               'Peggy', 'Rupert', 'Sybil', 'Trent', 'Victor', 'Walter']
+LAST_NAMES = ['Smith', 'Jones', 'Garcia', 'Miller', 'Davis', 'Lopez',
+              'Wilson', 'Moore', 'Taylor', 'Thomas']
+WORDS = ['ok', 'see', 'you', 'at', 'the', 'meeting', 'tomorrow', 'thanks',
+         'class', 'is', 'cancelled', 'did', 'anyone', 'get', 'homework',
+         'lol', 'yes', 'no', 'maybe', 'call', 'me', 'later', 'school',
+         'teacher', 'said', 'we', 'should', 'start', 'early', 'today']
+
+
+def header(time):
+    """Return the export header for a datetime."""
+    return('%d/%d/%s, %d:%s %s - ' % (time.month, time.day,
+                                      time.strftime('%y'),
+                                      int(time.strftime('%I')),
+                                      time.strftime('%M'),
+                                      time.strftime('%p')))
+
+
+def sentence(rng, low=2, high=16):
+    """Return a random lowercase sentence."""
+    return(' '.join(rng.choice(WORDS) for _ in range(rng.randint(low, high))))
+
+
+def phone_number(rng):
+    """Return a random US phone number in the export's format."""
+    return('+1 (%03d) %03d-%04d' % (rng.randint(200, 999),
+                                    rng.randint(200, 999),
+                                    rng.randint(0, 9999)))
+
+
+def contact_detail(rng):
+    """Return a random phone number, email, link or mention."""
+    name = rng.choice(FIRST_NAMES)
+    return(rng.choice([
+        phone_number(rng),
+        '+44 7%03d %06d' % (rng.randint(0, 999), rng.randint(0, 999999)),
+        '0%d %04d %04d' % (rng.randint(20, 99), rng.randint(0, 9999),
+                           rng.randint(0, 9999)),
+        '%s.%s@example.com' % (name.lower(), rng.choice(LAST_NAMES).lower()),
+        'https://example.com/%s/%d' % (name, rng.randint(0, 9999)),
+        '@%s' % name]))
+
+
+def generate_messages(n_messages, seed=0):
+    """Yield n_messages export messages, each starting with its header."""
+    rng = random.Random(seed)
+    senders = ['%s %s' % (rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES))
+               for _ in range(30)] + [phone_number(rng) for _ in range(5)]
+    time = datetime(2020, 3, 1, 8, 0)
+    for i in range(n_messages):
+        time += timedelta(minutes=rng.choice([0, 0, 1, 1, 2, 5, 30]))
+        kind = rng.random()
+        if i == 0:
+            yield(header(time) + 'Messages to this group are now secured '
+                  'with end-to-end encryption. Tap for more info.')
+            continue
+        elif kind < 0.02:
+            yield(header(time) + '%s added %s' % (rng.choice(senders),
+                                                  rng.choice(senders)))
+            continue
+
+        if kind < 0.07:
+            body = '\n'.join(sentence(rng)
+                             for _ in range(rng.randint(2, 5)))
+        elif kind < 0.12:
+            body = '%s- %s' % (rng.choice(FIRST_NAMES), sentence(rng))
+        elif kind < 0.17:
+            body = 'reach me at %s %s' % (contact_detail(rng), sentence(rng))
+        elif kind < 0.22:
+            body = '<Media omitted>'
+        elif kind < 0.40:
+            body = '%s %s %s' % (sentence(rng, 1, 5), rng.choice(FIRST_NAMES),
+                                 sentence(rng, 1, 8))
+        else:
+            body = sentence(rng)
+        yield(header(time) + rng.choice(senders) + ': ' + body)
+
+
+def write_export(path, n_messages, seed=0, bom=False):
+    """Write a synthetic export with n_messages messages to path.
+
+    With bom=True the file starts with a byte order mark, as files saved
+    by Windows editors do.
+    """
+    with open(path, 'w', encoding='utf-8-sig' if bom else 'utf-8') as file:
+        for message in generate_messages(n_messages, seed):
+            file.write(message + '\n\n')
+
+
+def write_names(path):
+    """Write a names list in the format of listofnames.csv."""
+    with open(path, 'w', encoding='utf-8') as file:
+        file.write('Name\n')
+        for name in FIRST_NAMES:
+            file.write(name.lower() + '\n')
+
+
+if __name__ == '__main__':
+    write_export(sys.argv[2], int(sys.argv[1]))
@@ -20,11 +20,11 @@ setuptools.setup(
     #url="https://github.com/RTeresiOB/WhatsApp_Anonymize",
     packages=setuptools.find_packages(),
     install_requires=[
-                     'pandas',
                      'pathlib',
                      'datetime',
                      'spacy',
                      'names',
+                     'numpy',
                      'cryptography'],
     classifiers=[
         "Programming Language :: Python :: 3",